@@ -6,6 +6,8 @@ import re
 import json
 import time
 import random
+from concurrent.futures import ThreadPoolExecutor
+from requests.utils import dict_from_cookiejar
 # 解决验证码问题，经过测试实际使用过程中不会出验证码，所以没装的话可以屏蔽掉
 # import pytesseract
 #from PIL import Image
@@ -23,13 +25,19 @@ from io import BytesIO
 6.删除网盘中的指定文件；
 7.移动网盘中指定文件至指定目录；
 8.创建分享链接；
+9.批量检查分享链接是否有效；
 '''
 class BaiDuPan(object):	
+	# 解析过的分享数据的有效期（秒），过期后重新打开分享页面
+	SHARE_CACHE_EXPIRE = 600
+
 	def __init__(self, bduss, stoken):
 		# 创建session并设置初始登录Cookie
 		self.session = requests.session()
 		self.session.cookies['BDUSS'] = bduss
 		self.session.cookies['STOKEN'] = stoken
+		# 按分享链接缓存验证后的Cookie和分享数据，重试或分批转存时不用再次打开页面、验证提取码
+		self.share_cache = {}
 		self.headers = {
 			'Host': 'pan.baidu.com',
 			'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.120 Safari/537.36',
@@ -217,14 +225,22 @@ class BaiDuPan(object):
 
 
 	'''
-	返回值errno代表的意思：
-	0 转存成功；1 无效的分享链接；2 分享文件已被删除；
-	3 分享文件已被取消；4 分享内容侵权，无法访问；5 找不到文件；6 分享文件已过期
-	7 获取提取码失败；8 获取加密cookie失败； 9 转存失败；
+	从链接中拆出提取码，例如https://pan.baidu.com/s/xxx?pwd=abcd
 	'''
-	def saveShare(self, url, pwd=None, path='/'):
-		share_res = self.session.get(url, headers=self.headers)
-		share_page = share_res.content.decode("utf-8")
+	@staticmethod
+	def splitShareUrl(url):
+		pos = url.find('?pwd=')
+		if(pos == -1):
+			return url, None
+		return url[:pos], url[pos + 5:]
+
+
+	'''
+	检查分享页面是否失效
+	返回值errno同saveShare的1~6，页面正常时返回None
+	'''
+	@staticmethod
+	def checkSharePage(share_res, share_page):
 		'''
 		1.如果分享链接有密码，会被重定向至输入密码的页面；
 		2.如果分享链接不存在，会被重定向至404页面https://pan.baidu.com/error/404.html，但是状态码是200；
@@ -235,17 +251,34 @@ class BaiDuPan(object):
 		7.啊哦，来晚了，该分享文件已过期
 		'''
 		if('error/404.html' in share_res.url):
-			return {"errno": 1, "err_msg": "无效的分享链接", "extra": "", "info": ""}
+			return {"errno": 1, "err_msg": "无效的分享链接"}
 		if('你来晚了，分享的文件已经被删除了，下次要早点哟' in share_page):
-			return {"errno": 2, "err_msg": "分享文件已被删除", "extra": "", "info": ""}
+			return {"errno": 2, "err_msg": "分享文件已被删除"}
 		if('你来晚了，分享的文件已经被取消了，下次要早点哟' in share_page):
-			return {"errno": 3, "err_msg": "分享文件已被取消", "extra": "", "info": ""}
+			return {"errno": 3, "err_msg": "分享文件已被取消"}
 		if('此链接分享内容可能因为涉及侵权、色情、反动、低俗等信息，无法访问' in share_page):
-			return {"errno": 4, "err_msg": "分享内容侵权，无法访问", "extra": "", "info": ""}
+			return {"errno": 4, "err_msg": "分享内容侵权，无法访问"}
 		if('链接错误没找到文件，请打开正确的分享链接' in share_page):
-			return {"errno": 5, "err_msg": "链接错误没找到文件", "extra": "", "info": ""}
+			return {"errno": 5, "err_msg": "链接错误没找到文件"}
 		if('啊哦，来晚了，该分享文件已过期' in share_page):
-			return {"errno": 6, "err_msg": "分享文件已过期", "extra": "", "info": ""}
+			return {"errno": 6, "err_msg": "分享文件已过期"}
+		return None
+
+
+	'''
+	打开分享链接，需要时验证提取码，并解析页面中locals.mset的分享数据
+	返回值errno同saveShare的0~8，成功时share_data为分享数据（bdstoken、shareid、share_uk、file_list等）
+	'''
+	def resolveShare(self, url, pwd=None):
+		cached = self.share_cache.get(url)
+		if(cached and time.time() - cached['time'] < self.SHARE_CACHE_EXPIRE):
+			self.session.cookies.update(cached['cookies'])
+			return {"errno": 0, "err_msg": "", "share_data": cached['share_data']}
+		share_res = self.session.get(url, headers=self.headers)
+		share_page = share_res.content.decode("utf-8")
+		page_error = self.checkSharePage(share_res, share_page)
+		if(page_error):
+			return page_error
 
 		# 提取码校验的请求中有此参数
 		bdstoken = re.findall(r'bdstoken\":\"(.+?)\"', share_page)
@@ -256,19 +289,42 @@ class BaiDuPan(object):
 			if(pwd == None):
 				pwd_result = self.getSharePwd(surl)
 				if(pwd_result['errno'] != 0):
-					return {"errno": 7, "err_msg": pwd_result['err_msg'], "extra": "", "info": ""}
+					return {"errno": 7, "err_msg": pwd_result['err_msg']}
 				else:
 					pwd = pwd_result['pwd']
 			referer = share_res.url
 			verify_result = self.verifyShare(surl, bdstoken, pwd, referer)
 			if(verify_result['errno'] != 0):
-				return {"errno": 8, "err_msg": verify_result['err_msg'], "extra": "", "info": ""}
+				return {"errno": 8, "err_msg": verify_result['err_msg']}
 			else:
 				# 加密分享验证通过后，使用全局session刷新页面（全局session中带有解密的Cookie）
 				share_res = self.session.get(url, headers=self.headers)
 				share_page = share_res.content.decode("utf-8")
 		# 更新bdstoken，有时候会出现 AttributeError: 'NoneType' object has no attribute 'group'，重试几次就好了
 		share_data = json.loads(re.search("locals.mset\(({.*})\)", share_page).group(1))
+		self.share_cache[url] = {'time': time.time(), 'cookies': dict_from_cookiejar(self.session.cookies), 'share_data': share_data}
+		return {"errno": 0, "err_msg": "", "share_data": share_data}
+
+
+	'''
+	丢弃分享链接的缓存，下次重新打开页面
+	'''
+	def invalidateShare(self, url):
+		self.share_cache.pop(url, None)
+
+
+	'''
+	返回值errno代表的意思：
+	0 转存成功；1 无效的分享链接；2 分享文件已被删除；
+	3 分享文件已被取消；4 分享内容侵权，无法访问；5 找不到文件；6 分享文件已过期
+	7 获取提取码失败；8 获取加密cookie失败； 9 转存失败；
+	fs_ids为要转存的文件id列表，不填时转存全部文件；分批转存时，分享数据只解析一次
+	'''
+	def saveShare(self, url, pwd=None, path='/', fs_ids=None):
+		resolve_result = self.resolveShare(url, pwd)
+		if(resolve_result['errno'] != 0):
+			return {"errno": resolve_result['errno'], "err_msg": resolve_result['err_msg'], "extra": "", "info": ""}
+		share_data = resolve_result['share_data']
 		bdstoken = share_data['bdstoken']
 		shareid = share_data['shareid']
 		_from = share_data['share_uk']
@@ -279,9 +335,11 @@ class BaiDuPan(object):
 		save_url = 'https://pan.baidu.com/share/transfer?shareid=%s&from=%s&async=1&channel=chunlei&web=1&app_id=250528&bdstoken=%s\
 					&logid=MTU3MjM1NjQzMzgyMTAuMjUwNzU2MTY4MTc0NzQ0MQ==&clienttype=0' % (shareid, _from, bdstoken)
 		file_list = share_data['file_list']
+		if(fs_ids == None):
+			fs_ids = [item['fs_id'] for item in file_list]
 		form_data = {
 			# 这个参数一定要注意，不能使用['fs_id', 'fs_id']，谨记！
-			'fsidlist': '[' + ','.join([str(item['fs_id']) for item in file_list]) + ']',
+			'fsidlist': '[' + ','.join([str(fs_id) for fs_id in fs_ids]) + ']',
 			'path': path,
 		}
 		headers = self.headers
@@ -296,11 +354,108 @@ class BaiDuPan(object):
 		save_json = save_res.json()
 		if save_json['errno'] == 4: # File already exist
 			return {'errno': 0, 'err_msg': 'File already exist', "extra": '', "info": ''}
+		if save_json['errno'] in [-6, -9]: # 登录或验证失效，缓存的分享数据不能再用
+			self.invalidateShare(url)
 
 		errno, err_msg, extra, info = (0, f'转存成功: {save_json["show_msg"]}', save_json['extra'], save_json['info']) if(save_json['errno'] == 0) else (9, f'转存失败({save_json["errno"]})： {save_json["show_msg"]}', '', '')
 		return {'errno': errno, 'err_msg': err_msg, "extra": extra, "info": info}
 
 
+	'''
+	统计分享目录下的文件数量和总大小，子目录递归统计
+	返回(文件数量, 总大小, 是否完整)，列表接口出错时统计不完整
+	'''
+	def countShareDir(self, share_data, dir):
+		file_count = 0
+		total_size = 0
+		page = 1
+		while True:
+			params = {
+				'uk': share_data['share_uk'],
+				'shareid': share_data['shareid'],
+				'dir': dir,
+				'order': 'name',
+				'desc': 0,
+				'showempty': 0,
+				'page': page,
+				'num': 100,
+				'web': 1,
+				'channel': 'chunlei',
+				'app_id': 250528,
+				'bdstoken': share_data['bdstoken'],
+				'clienttype': 0,
+			}
+			list_json = self.session.get('https://pan.baidu.com/share/list', headers=self.headers, params=params).json()
+			if(list_json.get('errno', -1) != 0):
+				return file_count, total_size, False
+			for item in list_json['list']:
+				if(int(item['isdir']) == 1):
+					count, size, complete = self.countShareDir(share_data, item['path'])
+					file_count += count
+					total_size += size
+					if(not complete):
+						return file_count, total_size, False
+				else:
+					file_count += 1
+					total_size += int(item['size'])
+			if(len(list_json['list']) < 100):
+				return file_count, total_size, True
+			page += 1
+
+
+	'''
+	检查分享链接是否有效，不转存
+	返回值errno同saveShare的0~8，另外10表示检查出错（如网络错误）
+	有效时返回文件数量file_count和总大小total_size，complete为False时统计不完整
+	'''
+	def checkShare(self, url, pwd=None):
+		result = {"errno": 0, "err_msg": "", "url": url, "file_count": 0, "total_size": 0, "complete": False}
+		try:
+			resolve_result = self.resolveShare(url, pwd)
+			if(resolve_result['errno'] != 0):
+				result.update(errno=resolve_result['errno'], err_msg=resolve_result['err_msg'])
+				return result
+			share_data = resolve_result['share_data']
+			complete = True
+			for item in share_data['file_list']:
+				if(int(item['isdir']) == 1):
+					count, size, dir_complete = self.countShareDir(share_data, item['path'])
+					complete = complete and dir_complete
+				else:
+					count, size = 1, int(item['size'])
+				result['file_count'] += count
+				result['total_size'] += size
+			result['complete'] = complete
+		except Exception as e:
+			result.update(errno=10, err_msg='检查出错：%s' % e)
+		return result
+
+
+	'''
+	批量检查分享链接，链接可带?pwd=提取码
+	使用有限的线程池，每个线程有自己的session（验证提取码的Cookie互不干扰），但共用一个连接池
+	解析的分享数据会加入缓存，之后转存这些链接时不用再次验证
+	adapter为共用的连接池，不填时新建
+	返回值为checkShare结果的列表，顺序与urls相同
+	'''
+	def checkShares(self, urls, max_workers=8, adapter=None):
+		if(adapter == None):
+			adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+		bduss = self.session.cookies.get('BDUSS', '')
+		stoken = self.session.cookies.get('STOKEN', '')
+		def check(url):
+			checker = BaiDuPan(bduss, stoken)
+			checker.session.mount('https://', adapter)
+			share_url, pwd = self.splitShareUrl(url)
+			result = checker.checkShare(share_url, pwd)
+			result['url'] = url
+			# 检查时解析的分享数据留给之后的转存使用
+			self.share_cache.update(checker.share_cache)
+			return result
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			return list(executor.map(check, urls))
+
+
 	'''
 	重命名指定文件
 	0 重命名成功；1 重命名失败；
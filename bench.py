@@ -0,0 +1,228 @@
+# Benchmark for the extract and copy stages, on generated workspaces.
+# Runs offline, only needs 7z. Usage: python bench.py --help
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import gecchi
+
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+DECOY_PASSWORDS = [f'decoy{i}' for i in range(10)]
+
+class Generator:
+    def __init__(self, seven_zip: str, scale: float, seed: int):
+        self.seven_zip = seven_zip
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.passwords = []
+
+    def count(self, n: int) -> int:
+        return max(1, int(n * self.scale))
+
+    def size(self, n: int) -> int:
+        return max(1024, int(n * self.scale))
+
+    # Random bytes look like already compressed media
+    def media_file(self, path: str, size: int):
+        with open(path, 'wb') as f:
+            f.write(JPEG_HEADER + self.rng.randbytes(size - len(JPEG_HEADER)))
+
+    def media_folder(self, folder: str, count: int, min_size: int, max_size: int):
+        os.makedirs(folder, exist_ok=True)
+        for i in range(count):
+            self.media_file(os.path.join(folder, f'{i:05d}.jpg'), self.rng.randint(min_size, max_size))
+
+    def archive(self, archive: str, sources: list, options: str = ''):
+        files = ' '.join(f'"{s}"' for s in sources)
+        result = subprocess.run(f'"{self.seven_zip}" a -mx=1 {options} "{archive}" {files}', shell=True, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'7z failed creating {archive}: {result.stderr}')
+
+    # Password placed at [position] of the password list (0.0: first, 1.0: last)
+    def password_at(self, position: float) -> str:
+        password = f'bench{len(self.passwords)}'
+        self.passwords.append((position, password))
+        return password
+
+    def build_passwords(self) -> list:
+        passwords = list(DECOY_PASSWORDS)
+        for position, password in sorted(self.passwords):
+            passwords.insert(int(position * len(passwords)), password)
+        return passwords
+
+    # Each scenario fills [content] like a finished download, in [work] scratch folder
+
+    def small_files(self, content: str, work: str):
+        self.media_folder(os.path.join(content, 'photos'), self.count(5000), 4 * 2**10, 64 * 2**10)
+        self.media_folder(os.path.join(content, 'more'), self.count(5000), 4 * 2**10, 64 * 2**10)
+
+    def loose_media(self, content: str, work: str):
+        for i in range(self.count(2000)):
+            self.media_file(os.path.join(content, f'IMG_{i:05d}.jpg'), self.rng.randint(100 * 2**10, 2 * 2**20))
+
+    def large_archive(self, content: str, work: str):
+        src = os.path.join(work, 'videos')
+        os.makedirs(src)
+        for i in range(4):
+            self.media_file(os.path.join(src, f'{i}.mp4'), self.size(64 * 2**20))
+        self.archive(os.path.join(content, 'videos.zip'), [src], '-mx=0')
+
+    def nested(self, content: str, work: str):
+        inner = os.path.join(work, 'inner')
+        self.media_folder(inner, self.count(200), 32 * 2**10, 256 * 2**10)
+        self.archive(os.path.join(work, 'inner.zip'), [inner])
+        middle = os.path.join(work, 'middle')
+        os.makedirs(middle)
+        shutil.move(os.path.join(work, 'inner.zip'), middle)
+        self.media_folder(os.path.join(middle, 'extra'), self.count(50), 32 * 2**10, 256 * 2**10)
+        self.archive(os.path.join(work, 'middle.7z'), [middle])
+        self.archive(os.path.join(content, 'outer.zip'), [os.path.join(work, 'middle.7z')])
+
+    def encrypted(self, content: str, work: str):
+        for i, position in enumerate([0.0, 0.5, 1.0]):
+            src = os.path.join(work, f'enc{i}')
+            self.media_folder(src, self.count(100), 32 * 2**10, 512 * 2**10)
+            # Encrypted headers: 7z has to try each password when listing
+            self.archive(os.path.join(content, f'enc{i}.7z'), [src], f'-mhe=on -p"{self.password_at(position)}"')
+        src = os.path.join(work, 'zipenc')
+        self.media_folder(src, self.count(100), 32 * 2**10, 512 * 2**10)
+        # Zip can be listed without password, the password is only needed when extracting
+        self.archive(os.path.join(content, 'zipenc.zip'), [src], f'-p"{self.password_at(1.0)}"')
+
+    def multi_volume(self, content: str, work: str):
+        src = os.path.join(work, 'volumes')
+        self.media_folder(src, self.count(40), 1 * 2**20, 4 * 2**20)
+        self.archive(os.path.join(content, 'set.7z'), [src], f'-v{max(1, int(16 * self.scale))}m')
+
+    def disguised(self, content: str, work: str):
+        src = os.path.join(work, 'hidden')
+        self.media_folder(src, self.count(100), 32 * 2**10, 256 * 2**10)
+        self.archive(os.path.join(work, 'hidden.zip'), [src])
+        shutil.move(os.path.join(work, 'hidden.zip'), os.path.join(content, 'cover.jpg'))
+        # Zip appended to a real looking image
+        src = os.path.join(work, 'appended')
+        self.media_folder(src, self.count(100), 32 * 2**10, 256 * 2**10)
+        self.archive(os.path.join(work, 'appended.zip'), [src])
+        self.media_file(os.path.join(content, 'photo.jpg'), 512 * 2**10)
+        with open(os.path.join(content, 'photo.jpg'), 'ab') as out, open(os.path.join(work, 'appended.zip'), 'rb') as zip_file:
+            shutil.copyfileobj(zip_file, out)
+        for i in range(self.count(500)):
+            self.media_file(os.path.join(content, f'plain{i:04d}.jpg'), self.rng.randint(100 * 2**10, 1 * 2**20))
+
+SCENARIOS = ['small_files', 'loose_media', 'large_archive', 'nested', 'encrypted', 'multi_volume', 'disguised']
+
+# Returns: (file count, total bytes)
+def count_files(folder: str) -> tuple:
+    count = 0
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(folder):
+        for name in file_names:
+            count += 1
+            size += os.path.getsize(os.path.join(dir_path, name))
+    return count, size
+
+def last_metrics(workspace: str) -> dict:
+    with open(os.path.join(workspace, gecchi.METRICS_FILE), encoding='utf-8') as f:
+        return json.loads(f.readlines()[-1])
+
+def run_scenario(name: str, root: str, args) -> list:
+    generator = Generator(args.seven_zip, args.scale, args.seed)
+    workspace = os.path.join(root, name, 'workspace')
+    library = os.path.join(args.library or root, name, 'library')
+    work = os.path.join(root, name, 'work')
+    for folder in [workspace, library, work]:
+        os.makedirs(folder)
+    os.mkdir(os.path.join(workspace, name))
+
+    gecchi.WORKSPACE = workspace
+    gecchi.CATEGORIES.clear()
+    gecchi.CATEGORIES['Bench'] = library
+    task = gecchi.Task()
+    task.initialize_new(workspace, name, 'bench', 'Bench')
+    getattr(generator, name)(task.content_folder, work)
+    shutil.rmtree(work)
+    gecchi.PASSWORDS[:] = generator.build_passwords()
+    task.set_status(gecchi.STATUS_DOWNLOADED)
+
+    input_size = count_files(task.content_folder)[1]
+    results = []
+    for stage in ['extract', 'copy']:
+        if stage == 'copy':
+            files, size = count_files(task.content_folder) # Copy may move the content away
+        output = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+            start = time.perf_counter()
+            success = task.run_one_stage()
+            seconds = time.perf_counter() - start
+        if not success:
+            print(output.getvalue())
+            raise RuntimeError(f'Stage {stage} failed for scenario {name}')
+        if stage == 'extract':
+            files, size = count_files(task.content_folder)
+        metrics = last_metrics(workspace)
+        results.append({
+            'scenario': name,
+            'stage': stage,
+            'seconds': seconds,
+            'files': files,
+            'bytes': size,
+            'input_bytes': input_size,
+            'files_per_second': files / seconds if seconds > 0 else 0,
+            'mb_per_second': size / seconds / 2**20 if seconds > 0 else 0,
+            'sevenzip_spawns': metrics['sevenzip_spawns'],
+            'password_attempts': metrics['password_attempts'],
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gecchi extract and copy stages on generated workspaces.')
+    parser.add_argument('--seven-zip', default=gecchi.SEVENZIP_PATH, help='7z executable (default: SEVENZIP_PATH or 7zz)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale factor for file counts and sizes')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, same seed gives same workspaces')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenario to run, can repeat (default: all)')
+    parser.add_argument('--dir', default=None, help='Folder to generate workspaces in (default: system temp)')
+    parser.add_argument('--library', default=None, help='Folder for category libraries, e.g. on another device (default: next to workspaces)')
+    parser.add_argument('--json', default=None, help='Also write results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep generated workspaces')
+    parser.add_argument('--verbose', action='store_true', help='Show gecchi output')
+    args = parser.parse_args()
+
+    if shutil.which(args.seven_zip) is None and not os.path.isfile(args.seven_zip):
+        print(f'7z executable not found: {args.seven_zip}')
+        sys.exit(-1)
+    gecchi.SEVENZIP_PATH = args.seven_zip
+    gecchi.DISK_SPACE_RESERVE = 0
+    gecchi.input = lambda prompt='': 'skip' # Never block on a password prompt
+
+    root = tempfile.mkdtemp(prefix='gecchi-bench-', dir=args.dir)
+    results = []
+    try:
+        for name in args.scenario or SCENARIOS:
+            print(f'Running scenario [{name}]...')
+            results += run_scenario(name, root, args)
+    finally:
+        if args.keep:
+            print(f'Workspaces kept in: {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+            if args.library is not None:
+                for name in args.scenario or SCENARIOS:
+                    shutil.rmtree(os.path.join(args.library, name), ignore_errors=True)
+
+    print(f'{"scenario":<14}{"stage":<9}{"seconds":>9}{"files":>8}{"MB":>9}{"files/s":>10}{"MB/s":>9}{"7z":>5}{"pwd":>5}')
+    for r in results:
+        print(f'{r["scenario"]:<14}{r["stage"]:<9}{r["seconds"]:>9.2f}{r["files"]:>8}{r["bytes"] / 2**20:>9.1f}'
+              f'{r["files_per_second"]:>10.1f}{r["mb_per_second"]:>9.1f}{r["sevenzip_spawns"]:>5}{r["password_attempts"]:>5}')
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'scale': args.scale, 'seed': args.seed, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import time
+import sqlite3
+import threading
+
+# Sources downloaded by tasks of the workspace, kept after the task folders are deleted.
+# Sources are normalized identifiers like "bt:<info hash>", looked up by primary key.
+class DownloadHistory:
+    def __init__(self, db_path: str):
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False) # Shared by workers, and by threads of intake
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, url TEXT, task TEXT, category TEXT, status TEXT, size INTEGER, created REAL, updated REAL)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # Returns: record of [source] as a dict, None if never seen
+    def find(self, source: str) -> dict:
+        with self.lock:
+            row = self.db.execute('SELECT source, url, task, category, status, size, created, updated FROM sources WHERE source = ?', (source,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['source', 'url', 'task', 'category', 'status', 'size', 'created', 'updated'], row))
+
+    # Size is kept from earlier records when not given
+    def record(self, source: str, url: str, task: str, category: str, status: str, size: int = None):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(source) DO UPDATE SET '
+                            'url = excluded.url, task = excluded.task, category = excluded.category, status = excluded.status, '
+                            'size = COALESCE(excluded.size, size), updated = excluded.updated',
+                            (source, url, task, category, status, size, now, now))
+            self.db.commit()
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, name length
+READ_SIZE = 64 * 2**10
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+# Watches entries directly inside a few folders. Uses inotify on Linux, so waiting costs nothing
+# until something happens. Elsewhere, or when inotify is unavailable, folder listings are compared
+# every [poll_interval] seconds.
+class FolderWatcher:
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.folders = {} # Watch descriptor (or folder when polling) -> folder
+        self.snapshots = {} # Folder -> {name: (size, mtime)}, only when polling
+        self.fd = -1
+        self.libc = load_libc()
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd < 0:
+                self.libc = None
+
+    def is_polling(self) -> bool:
+        return self.fd < 0
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add(self, folder: str) -> bool:
+        if self.is_polling():
+            self.folders[folder] = folder
+            self.snapshots[folder] = snapshot(folder)
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            return False
+        self.folders[wd] = folder
+        return True
+
+    # Waits up to [timeout] seconds (None: until something happens).
+    # Returns: list of (folder, name, finished), finished when the entry was closed after writing or moved in,
+    # so it is complete. Entries only created or modified may still be written.
+    def wait(self, timeout: float = None) -> list:
+        if self.is_polling():
+            return self.poll(timeout)
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events += [(folder, '', False) for folder in self.folders.values()] # Events lost, look at everything
+            elif wd in self.folders and name != '':
+                events.append((self.folders[wd], name, mask & (IN_CLOSE_WRITE | IN_MOVED_TO) != 0))
+        return events
+
+    def poll(self, timeout: float) -> list:
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        events = []
+        for folder in self.folders.values():
+            current = snapshot(folder)
+            previous = self.snapshots[folder]
+            events += [(folder, name, False) for name, signature in current.items() if previous.get(name) != signature]
+            self.snapshots[folder] = current
+        return events
+
+# Returns: {name: (size, mtime)} of entries in [folder]
+def snapshot(folder: str) -> dict:
+    ret = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                ret[entry.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return ret
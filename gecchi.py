@@ -5,13 +5,43 @@ import sys
 import json
 import time
 import datetime
-import readline
-from baidu_share import BaiDuPan
-from dataclasses import dataclass
+import atexit
+import cProfile
+import pstats
+import contextlib
+import queue
+import threading
+import errno
+import mmap
+import re
+import tempfile
+import sqlite3
+import tarfile
+import shlex
+import base64
+import heapq
+import hashlib
+import socket
+import select
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from library_index import LibraryIndex, link_file, DEDUP_MIN_SIZE
+from download_history import DownloadHistory
+from task_lease import TaskLease, LeaseLost, get_worker_id, read_lease, is_leased
+from folder_watch import FolderWatcher
+from dataclasses import dataclass, asdict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, resource slots are not shared between processes
 
 STATUS = 'STATUS'
 URL = 'URL'
 CATEGORY = 'CATEGORY'
+COPIED = 'COPIED' # Content entries already copied to the category folder
+SKIPPED = 'SKIPPED' # Torrent files not downloaded, removed from content once the download completes
+PENDING = 'PENDING' # Content archives waiting for a password, left out of copying
+JOURNAL = 'JOURNAL' # Extraction progress of content files, JSON lines, removed once extraction is done
 
 STATUS_UNKNOWN = 'Not Started'
 STATUS_DOWNLOADED = 'Downloaded'
@@ -20,14 +50,208 @@ STATUS_DONE = 'Done'
 
 CONTENT_FOLDER = 'content'
 TEMP_FOLDER = 'temp'
+LIBRARY_INDEX_FILE = 'library.db'
+HISTORY_FILE = 'history.db'
+METRICS_FILE = 'metrics.jsonl'
+PROMETHEUS_FILE = 'metrics.prom'
+PROFILE_FILE = 'profile.pstats'
+TOOLS_CACHE_FILE = '.tools.json' # Probe results of external tools, keyed by binary path and mtime
+PASSWORDS_FILE = 'passwords.txt' # Extra archive passwords, one per line
 
 CATEGORIES = {}
 PASSWORDS = ['⑨', '米粒儿']
 #ARCHIVE_FORMATS = ['.jpg', '.7z', '.zip', '.rar']
 MEDIA_FORMATS = ['.jpg', '.jpeg', '.png', '.mp4', '.mkv', '.mp3', '.wav', '.apk', '.zip', '.7z', '.rar']
+# Torrent file selection only: more media types, so a torrent of them is not taken for something else
+BT_MEDIA_FORMATS = MEDIA_FORMATS + ['.gif', '.webp', '.bmp', '.tif', '.tiff', '.heic', '.avif',
+                                   '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v', '.ts', '.rmvb',
+                                   '.flac', '.ape', '.m4a', '.aac', '.ogg', '.opus', '.wma']
+# Small files that belong with media (subtitles, cue sheets, lyrics), kept when selecting torrent files
+MEDIA_COMPANION_FORMATS = ['.srt', '.ass', '.ssa', '.vtt', '.sub', '.idx', '.sup', '.cue', '.lrc']
 MEDIA_RATIO_THRESHOLD = 0.5
 ARCHIVE_FILECOUNT_THRESHOLD = 10
 
+# Signatures of photo and video formats. Only files starting like one of these skip 7z, and only when
+# no archive signature shows up where an appended archive would be: anything else goes to 7z, which
+# knows far more formats than could be listed here.
+MEDIA_HEAD_SIGNATURES = [
+    (0, b'\xff\xd8\xff'),           # jpeg
+    (0, b'\x89PNG\r\n\x1a\n'),      # png
+    (0, b'GIF8'),                   # gif
+    (0, b'II*\x00'),                # tiff, little endian
+    (0, b'MM\x00*'),                # tiff, big endian
+    (0, b'RIFF'),                   # webp, avi, wav
+    (4, b'ftyp'),                   # mp4, mov, m4a, heic
+    (0, b'\x1a\x45\xdf\xa3'),       # mkv, webm
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'), # asf, wmv
+    (0, b'FLV\x01'),                # flv
+    (0, b'\x00\x00\x01\xba'),       # mpeg program stream
+    (0, b'fLaC'),                   # flac
+    (0, b'OggS'),                   # ogg
+    (0, b'ID3'),                    # mp3
+]
+# Signatures of archives appended to media, searched in the whole file, or its head and tail when large
+ARCHIVE_SIGNATURES = [
+    b'7z\xbc\xaf\x27\x1c',      # 7z
+    b'Rar!\x1a\x07',            # rar 4 / 5
+]
+# Searched only near the tail, where zip keeps its central directory. Short signatures like this
+# one turn up by chance in large media files.
+ARCHIVE_TAIL_SIGNATURES = [
+    b'PK\x05\x06',              # zip end of central directory
+]
+# Volumes after the first one have no signature, let 7z decide for them
+ARCHIVE_VOLUME_PATTERN = re.compile(r'\.(\d{3}|z\d{2}|r\d{2})$', re.IGNORECASE)
+# Volume suffixes of archive sets, and the suffix standing for the whole set: "a.part2.rar" and "a.r00" belong
+# to "a.rar", "a.z01" to "a.zip", "a.7z.001" to "a.7z". Sets of different formats never share a name.
+ARCHIVE_SET_PATTERNS = [
+    (re.compile(r'\.part\d+\.rar$', re.IGNORECASE), '.rar'),
+    (re.compile(r'\.(rar|r\d{2})$', re.IGNORECASE), '.rar'),
+    (re.compile(r'\.(zip|z\d{2})$', re.IGNORECASE), '.zip'),
+    (re.compile(r'\.\d{3}$'), ''),
+]
+SNIFF_WINDOW = 2**20 # Bytes sniffed at the head and the tail of a file
+SNIFF_FULL_SCAN_SIZE = 64 * 2**20 # Files up to this size are scanned entirely
+
+DISK_SPACE_RESERVE = 2**30 # Free space to always keep on any filesystem
+BT_POLL_INTERVAL = 1.0 # Seconds between BT progress checks
+BT_SAFETY_POLL_INTERVAL = 60.0 # Seconds between BT progress checks while waiting for the completion hook
+BT_HOOK_FOLDER = '.bt-hook' # Completion markers written by the qBittorrent hook, in the workspace
+BT_MARKER_MAX_AGE = 24 * 3600
+
+# Resource classes used by each stage. Slots of a class are shared by all gecchi processes on the workspace.
+STAGE_RESOURCES = {
+    'download': ['network', 'scratch'],
+    'extract': ['cpu', 'scratch'],
+    'copy': ['scratch', 'dest'],
+}
+RESOURCE_LOCK_FOLDER = '.locks'
+RESOURCE_POLL_INTERVAL = 2.0
+# (ionice class, ionice level, nice) for child processes of each stage, Linux only
+STAGE_IO_PRIORITY = {
+    'extract': (2, 7, 10),
+    'copy': (2, 4, 0),
+}
+
+WORKSPACE = '' # Set from command line
+
+# Environment
+if os.name == 'nt':
+    SEVENZIP_PATH = os.environ.get('SEVENZIP_PATH', '7z.exe')
+else:
+    SEVENZIP_PATH = os.environ.get('SEVENZIP_PATH', '7zz')
+
+MEGACMD_FOLDER = os.environ.get('MEGACMD_FOLDER', '')
+
+QBT_PATH = os.environ.get('QBT_PATH', 'qbt') # qBittorrent command line client
+# qBittorrent WebUI, only used to install the completion hook
+QBT_URL = os.environ.get('QBT_URL', '').rstrip('/')
+QBT_USERNAME = os.environ.get('QBT_USERNAME', '')
+QBT_PASSWORD = os.environ.get('QBT_PASSWORD', '')
+
+# Prometheus textfile for the node exporter textfile collector, defaults to metrics.prom in the workspace
+PROMETHEUS_PATH = os.environ.get('GECCHI_PROM_FILE', '')
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    if text != '' and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# Parses "key=value,key=value". Returns None if invalid.
+def parse_settings(text: str, parse_value) -> dict:
+    ret = {}
+    try:
+        for item in text.split(','):
+            if item.strip() == '':
+                continue
+            key, value = item.split('=', 1)
+            ret[key.strip()] = parse_value(value)
+    except ValueError:
+        return None
+    return ret
+
+# Max concurrent stages using each resource class, e.g. "network=2,scratch=1,dest=1,cpu=4"
+RESOURCE_LIMITS = {'network': 2, 'scratch': 2, 'dest': 1, 'cpu': os.cpu_count() or 1}
+limits = parse_settings(os.environ.get('GECCHI_RESOURCE_LIMITS', ''), int)
+if limits is None:
+    print('Warning: invalid GECCHI_RESOURCE_LIMITS, expecting e.g. "network=2,scratch=1,dest=1,cpu=4".')
+else:
+    RESOURCE_LIMITS.update(limits)
+
+# Bandwidth caps in bytes per second for backends: bt, mega, copy. e.g. "bt=10M,copy=50M"
+BANDWIDTH_LIMITS = parse_settings(os.environ.get('GECCHI_BANDWIDTH', ''), parse_size)
+if BANDWIDTH_LIMITS is None:
+    print('Warning: invalid GECCHI_BANDWIDTH, expecting e.g. "bt=10M,mega=5M,copy=50M".')
+    BANDWIDTH_LIMITS = {}
+if 'baidu' in BANDWIDTH_LIMITS:
+    print('Warning: bypy cannot limit bandwidth, baidu cap ignored.')
+
+# Small-file copy for network destinations, where creating each file costs round trips:
+# copy files with this many threads, or pack small files into one tar stream for the receiver command,
+# e.g. "tar -xf - -C {dest}" ({dest} is replaced by the destination folder). Large files are copied directly.
+try:
+    COPY_THREADS = int(os.environ.get('GECCHI_COPY_THREADS', '0') or '0')
+except ValueError:
+    print('Warning: invalid GECCHI_COPY_THREADS, expecting a number of threads. Copying with one thread.')
+    COPY_THREADS = 0
+COPY_RECEIVER = os.environ.get('GECCHI_COPY_RECEIVER', '')
+SMALL_FILE_SIZE = 2**20
+
+# Large non-solid archives are extracted by several 7z processes, each taking a share of the entries. 0 or 1: one process.
+# Every process past the first needs a free "cpu" slot, so parallel extraction never goes over the cpu limit.
+try:
+    EXTRACT_WORKERS = int(os.environ.get('GECCHI_EXTRACT_WORKERS', '0') or '0')
+except ValueError:
+    print('Warning: invalid GECCHI_EXTRACT_WORKERS, expecting a number of processes. Extracting with one process.')
+    EXTRACT_WORKERS = 0
+PARALLEL_EXTRACT_SIZE = 256 * 2**20 # Smaller archives are extracted by one process
+
+IONICE_AVAILABLE = os.name != 'nt' and shutil.which('ionice') is not None
+
+# Profile stages with cProfile and time every child process, summary printed at exit
+PROFILE = os.environ.get('GECCHI_PROFILE', '') not in ['', '0']
+
+# Copy final files to the category folder in background while extraction is still running
+PIPELINE = os.environ.get('GECCHI_PIPELINE', '') not in ['', '0']
+
+# Link files already in the library instead of copying them again: "hardlink", "reflink" or empty to disable
+DEDUP_MODE = os.environ.get('GECCHI_DEDUP', '')
+if DEDUP_MODE not in ['', 'hardlink', 'reflink']:
+    print(f'Warning: unknown GECCHI_DEDUP mode [{DEDUP_MODE}], deduplication disabled. Use "hardlink" or "reflink".')
+    DEDUP_MODE = ''
+
+# Check the library index for the content of a task before downloading and copying:
+# "warn" to ask whether to skip a redundant task, "skip" to skip it without asking, or empty to disable
+LIBRARY_CHECK = os.environ.get('GECCHI_LIBRARY_CHECK', '')
+if LIBRARY_CHECK not in ['', 'warn', 'skip']:
+    print(f'Warning: unknown GECCHI_LIBRARY_CHECK mode [{LIBRARY_CHECK}], library check disabled. Use "warn" or "skip".')
+    LIBRARY_CHECK = ''
+
+# Put archives with unknown password aside instead of asking, so the other stages go on. They are
+# resumed once new passwords show up in passwords.txt of the workspace (or the "password" command).
+DEFER_PASSWORDS = os.environ.get('GECCHI_DEFER_PASSWORDS', '') not in ['', '0']
+
+# qBittorrent runs "gecchi.py WORKSPACE bt-hook %I" when a torrent finishes (see "bt-hook install"),
+# so BT downloads wait for it instead of polling, only checking progress every BT_SAFETY_POLL_INTERVAL
+BT_HOOK = os.environ.get('GECCHI_BT_HOOK', '') not in ['', '0']
+
+# Select torrent files by the media rules of extraction once metadata arrives: "ask" to confirm skipping
+# the other files, "auto" to skip them without asking, or empty to download everything
+BT_SELECT = os.environ.get('GECCHI_BT_SELECT', '')
+if BT_SELECT not in ['', 'ask', 'auto']:
+    print(f'Warning: unknown GECCHI_BT_SELECT mode [{BT_SELECT}], torrent file selection disabled. Use "ask" or "auto".')
+    BT_SELECT = ''
+
+# Drop folder of the "intake" command (default: ".intake" in the workspace). Items dropped into its
+# subfolder named after a category get that category, items dropped at its top get GECCHI_INTAKE_CATEGORY.
+INTAKE_FOLDER = os.environ.get('GECCHI_INTAKE', '')
+INTAKE_CATEGORY = os.environ.get('GECCHI_INTAKE_CATEGORY', '')
+
+BDUSS = os.environ.get('BDUSS', '')
+STOKEN = os.environ.get('STOKEN', '')
+
 @dataclass
 class ArchiveInfo:
     is_archive: bool = False
@@ -36,7 +260,9 @@ class ArchiveInfo:
     volumes: int = -1
     volume_index: int = -1
     file_count: int = 0
+    total_size: int = 0
     media_ratio: float = 0.0
+    solid: bool = False
 
 @dataclass
 class BtInfo:
@@ -50,6 +276,345 @@ class BtInfo:
     eta: int = -1
     time_active: int = -1
 
+@dataclass
+class StageMetrics:
+    task: str = ''
+    stage: str = ''
+    category: str = ''
+    started: float = 0.0
+    success: bool = False
+    seconds: float = 0.0
+    bytes: int = 0
+    throughput: float = 0.0 # bytes per second
+    sevenzip_spawns: int = 0
+    password_attempts: int = 0
+
+current_metrics = None # StageMetrics of the running stage
+
+def count_metric(name: str, value: int = 1):
+    if current_metrics is not None:
+        setattr(current_metrics, name, getattr(current_metrics, name) + value)
+
+METRICS_STATE_FILE = '.metrics-state.json' # Running totals of metrics.jsonl, and how far it was read
+
+# Returns: running totals {'offset', 'runs', 'totals', 'last'} brought up to date with records appended
+# since, by this or other processes. Rebuilt from the whole file if the state is missing or stale.
+def update_metrics_state(metrics_path: str, state_path: str) -> dict:
+    state = None
+    try:
+        with open(state_path, encoding='utf-8') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        pass
+    if state is None or state.get('offset', 0) > os.path.getsize(metrics_path):
+        state = {'offset': 0, 'runs': {}, 'totals': {}, 'last': {}}
+    with open(metrics_path, 'rb') as file:
+        file.seek(state['offset'])
+        for line in file:
+            if not line.endswith(b'\n'):
+                break # Being written, picked up next time
+            state['offset'] += len(line)
+            try:
+                m = json.loads(line)
+            except ValueError:
+                continue
+            stage = m['stage']
+            result = 'success' if m['success'] else 'failure'
+            runs = state['runs'].setdefault(stage, {})
+            runs[result] = runs.get(result, 0) + 1
+            total = state['totals'].setdefault(stage, {'seconds': 0.0, 'bytes': 0, 'sevenzip_spawns': 0, 'password_attempts': 0})
+            for key in total:
+                total[key] += m[key]
+            state['last'][stage] = m
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(state, file, ensure_ascii=False)
+    os.replace(state_path + '.tmp', state_path)
+    return state
+
+# Appends a stage record to the JSON lines file and rewrites the Prometheus textfile from running totals.
+def record_metrics(metrics: StageMetrics):
+    metrics_path = os.path.join(WORKSPACE, METRICS_FILE)
+    with open(metrics_path, 'a', encoding='utf-8') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX) # Other gecchi processes update the same totals, released on close
+        file.write(json.dumps(asdict(metrics), ensure_ascii=False) + '\n')
+        file.flush()
+        state = update_metrics_state(metrics_path, os.path.join(WORKSPACE, METRICS_STATE_FILE))
+    runs = {(stage, result): count for stage, results in state['runs'].items() for result, count in results.items()}
+    totals = state['totals']
+    last = state['last']
+
+    lines = []
+    def add(name, kind, help, samples):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+    add('gecchi_stage_runs_total', 'counter', 'Stage runs by result.',
+        [({'stage': stage, 'result': result}, count) for (stage, result), count in sorted(runs.items())])
+    add('gecchi_stage_seconds_total', 'counter', 'Wall time spent in stages.',
+        [({'stage': stage}, total['seconds']) for stage, total in sorted(totals.items())])
+    add('gecchi_stage_bytes_total', 'counter', 'Bytes moved by stages.',
+        [({'stage': stage}, total['bytes']) for stage, total in sorted(totals.items())])
+    add('gecchi_sevenzip_spawns_total', 'counter', '7z processes started by stages.',
+        [({'stage': stage}, total['sevenzip_spawns']) for stage, total in sorted(totals.items())])
+    add('gecchi_password_attempts_total', 'counter', 'Archive passwords tried by stages.',
+        [({'stage': stage}, total['password_attempts']) for stage, total in sorted(totals.items())])
+    add('gecchi_stage_last_seconds', 'gauge', 'Wall time of the last run of each stage.',
+        [({'stage': stage}, m['seconds']) for stage, m in sorted(last.items())])
+    add('gecchi_stage_last_throughput_bytes_per_second', 'gauge', 'Throughput in bytes per second of the last run of each stage.',
+        [({'stage': stage}, m['throughput']) for stage, m in sorted(last.items())])
+    add('gecchi_stage_last_timestamp_seconds', 'gauge', 'Start time of the last run of each stage.',
+        [({'stage': stage}, m['started']) for stage, m in sorted(last.items())])
+
+    # Write then rename, so the textfile collector never reads a partial file
+    prom_path = PROMETHEUS_PATH if PROMETHEUS_PATH != '' else os.path.join(WORKSPACE, PROMETHEUS_FILE)
+    with open(prom_path + '.tmp', 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(prom_path + '.tmp', prom_path)
+
+@dataclass
+class ChildCommand:
+    stage: str
+    program: str
+    command: str
+    seconds: float
+    returncode: int
+
+child_commands = [] # ChildCommand list, only recorded when profiling
+stage_profiles = [] # (stage, seconds, cProfile.Profile), only recorded when profiling
+
+def get_program(cmd: str) -> str:
+    cmd = cmd.strip()
+    if cmd.startswith('"'):
+        program = cmd[1:cmd.find('"', 1)]
+    else:
+        program = cmd.split(' ', 1)[0]
+    return os.path.basename(program)
+
+# Prefixes [cmd] with the I/O and CPU priority of the current stage
+def get_run_command(cmd: str) -> str:
+    priority = STAGE_IO_PRIORITY.get(current_metrics.stage) if current_metrics is not None else None
+    if priority is not None and IONICE_AVAILABLE:
+        io_class, io_level, nice = priority
+        return f'ionice -c {io_class} -n {io_level} nice -n {nice} {cmd}'
+    return cmd
+
+# Records a child process that ran [cmd] since [start] (time.perf_counter), when profiling
+def record_child_command(cmd: str, start: float, returncode: int):
+    if PROFILE:
+        stage = current_metrics.stage if current_metrics is not None else '-'
+        child_commands.append(ChildCommand(stage, get_program(cmd), cmd, time.perf_counter() - start, returncode))
+
+def run_command(cmd: str, **kwargs) -> subprocess.CompletedProcess:
+    run_cmd = get_run_command(cmd)
+    if not PROFILE:
+        return subprocess.run(run_cmd, shell=True, **kwargs)
+    start = time.perf_counter()
+    result = subprocess.run(run_cmd, shell=True, **kwargs)
+    record_child_command(cmd, start, result.returncode)
+    return result
+
+# Runs [cmd] and hands each stdout line to [on_line] as it comes, so the output is never held whole.
+# stderr goes to a temporary file, a pipe could fill up and block the child.
+# Returns: (returncode, stderr)
+def run_command_lines(cmd: str, on_line) -> tuple:
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(get_run_command(cmd), shell=True, stdout=subprocess.PIPE, stderr=err, text=True)
+        for line in process.stdout:
+            on_line(line.rstrip('\r\n'))
+        process.stdout.close()
+        returncode = process.wait()
+        err.seek(0)
+        stderr = err.read().decode(errors='replace')
+    record_child_command(cmd, start, returncode)
+    return returncode, stderr
+
+def print_profile_summary():
+    if len(stage_profiles) == 0 and len(child_commands) == 0:
+        return
+    print('')
+    print('=============== Gecchi profile ===============')
+    stage_seconds = {}
+    for stage, seconds, profiler in stage_profiles:
+        stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+    child_seconds = {}
+    groups = {}
+    for c in child_commands:
+        child_seconds[c.stage] = child_seconds.get(c.stage, 0.0) + c.seconds
+        group = groups.setdefault((c.stage, c.program), [0, 0.0, 0])
+        group[0] += 1
+        group[1] += c.seconds
+        if c.returncode != 0:
+            group[2] += 1
+
+    print(f'{"stage":<10}{"wall":>10}{"children":>10}{"python":>10}')
+    for stage, seconds in sorted(stage_seconds.items(), key=lambda x: -x[1]):
+        child = child_seconds.get(stage, 0.0)
+        print(f'{stage:<10}{seconds:>9.2f}s{child:>9.2f}s{seconds - child:>9.2f}s')
+
+    print('')
+    print('Child processes by stage and program:')
+    print(f'{"stage":<10}{"program":<20}{"count":>7}{"total":>10}{"mean":>9}{"failed":>8}')
+    for (stage, program), (count, seconds, failed) in sorted(groups.items(), key=lambda x: -x[1][1]):
+        print(f'{stage:<10}{program:<20}{count:>7}{seconds:>9.2f}s{seconds / count:>8.3f}s{failed:>8}')
+
+    print('')
+    print('Slowest child processes:')
+    for c in sorted(child_commands, key=lambda c: -c.seconds)[:10]:
+        print(f'{c.seconds:>9.2f}s [{c.stage}] exit {c.returncode}: {c.command}')
+
+    if len(stage_profiles) > 0:
+        stats = pstats.Stats(stage_profiles[0][2])
+        for stage, seconds, profiler in stage_profiles[1:]:
+            stats.add(profiler)
+        path = os.path.join(WORKSPACE, PROFILE_FILE)
+        stats.dump_stats(path)
+        print('')
+        print(f'Python functions by own time (full profile saved to [{path}]):')
+        stats.sort_stats('tottime').print_stats(15)
+
+# Takes a free slot of a resource class without waiting. Returns: the locked slot file, None if all slots are used.
+# Slots must be supported (fcntl available).
+def try_acquire_resource(resource: str):
+    folder = os.path.join(WORKSPACE, RESOURCE_LOCK_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(max(RESOURCE_LIMITS.get(resource, 1), 1)):
+        file = open(os.path.join(folder, f'{resource}.{i}'), 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return file
+        except OSError:
+            file.close()
+    return None
+
+# Waits for a free slot of a resource class. Returns: the locked slot file, None if slots are not supported.
+def acquire_resource(resource: str):
+    if fcntl is None:
+        return None
+    waiting = False
+    while True:
+        file = try_acquire_resource(resource)
+        if file is not None:
+            return file
+        if not waiting:
+            print(f'Waiting for a free [{resource}] slot, used by other gecchi processes...')
+            waiting = True
+        time.sleep(RESOURCE_POLL_INTERVAL)
+
+# Holds one slot of each resource class. Slots are taken in a fixed order, so processes never deadlock.
+# Locks are released by closing the files, or by the OS if the process dies.
+@contextlib.contextmanager
+def use_resources(resources: list):
+    global held_resources
+    held = [] # (resource, lock file)
+    try:
+        for resource in sorted(resources):
+            held.append((resource, acquire_resource(resource)))
+        held_resources = held
+        yield
+    finally:
+        held_resources = []
+        for resource, file in held:
+            if file is not None:
+                file.close()
+
+held_resources = [] # (resource, lock file) of the running stage
+
+# Gives the slots of the running stage back while it only waits for another program, e.g. qBittorrent
+# downloading a torrent for hours, and takes them again afterwards.
+@contextlib.contextmanager
+def release_resources():
+    held = held_resources
+    for i in range(len(held)):
+        if held[i][1] is not None:
+            held[i][1].close()
+        held[i] = (held[i][0], None)
+    try:
+        yield
+    finally:
+        for i in range(len(held)):
+            held[i] = (held[i][0], acquire_resource(held[i][0]))
+
+# Copies a file or folder while keeping the average speed under [rate] bytes per second
+def copy_throttled(src: str, dest_folder: str, rate: int) -> bool:
+    dest = os.path.join(dest_folder, os.path.basename(src))
+    try:
+        if os.path.isdir(src):
+            os.makedirs(dest, exist_ok=True)
+            for file in os.listdir(src):
+                if not copy_throttled(os.path.join(src, file), dest, rate):
+                    return False
+            return True
+        start = time.perf_counter()
+        copied = 0
+        with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+            while True:
+                chunk = fin.read(2**20)
+                if not chunk:
+                    break
+                fout.write(chunk)
+                copied += len(chunk)
+                ahead = copied / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        shutil.copystat(src, dest)
+        return True
+    except OSError as e:
+        print(f'Failed copying [{src}]: {e}')
+        return False
+
+# Copies [srcs] files or folders into [dest_folder]: small files as one tar stream to COPY_RECEIVER if set,
+# the rest with COPY_THREADS threads. All entries of a copy share the one receiver and the one thread pool.
+def copy_packed(srcs: list, dest_folder: str) -> bool:
+    folders = []
+    small = [] # (path, path relative to dest_folder)
+    large = []
+    for src in srcs:
+        parent = os.path.dirname(os.path.abspath(src))
+        if os.path.isdir(src):
+            for dir_path, dir_names, file_names in os.walk(src):
+                folders.append(os.path.relpath(dir_path, parent))
+                for name in file_names:
+                    path = os.path.join(dir_path, name)
+                    (small if os.path.getsize(path) < SMALL_FILE_SIZE else large).append((path, os.path.relpath(path, parent)))
+        else:
+            (small if os.path.getsize(src) < SMALL_FILE_SIZE else large).append((src, os.path.basename(src)))
+    if COPY_RECEIVER == '':
+        large += small
+        small = []
+
+    try:
+        for folder in folders:
+            os.makedirs(os.path.join(dest_folder, folder), exist_ok=True)
+        if len(small) > 0:
+            receiver_cmd = COPY_RECEIVER.format(dest=shlex.quote(dest_folder))
+            start = time.perf_counter()
+            receiver = subprocess.Popen(get_run_command(receiver_cmd), shell=True, stdin=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=receiver.stdin, mode='w|', bufsize=2**20) as tar:
+                    for path, name in small:
+                        tar.add(path, arcname=name, recursive=False)
+            finally:
+                try:
+                    receiver.stdin.close()
+                except BrokenPipeError:
+                    pass # Receiver exited early, its status tells why
+                returncode = receiver.wait()
+                record_child_command(receiver_cmd, start, returncode)
+            if returncode != 0:
+                print(f'Receiver command failed with code {returncode}.')
+                return False
+        with ThreadPoolExecutor(max_workers=max(1, COPY_THREADS)) as executor:
+            for dest in executor.map(lambda item: shutil.copy2(item[0], os.path.join(dest_folder, item[1])), large):
+                pass
+        return True
+    except (OSError, tarfile.TarError) as e:
+        print(f'Failed copying to [{dest_folder}]: {e}')
+        return False
+
 def read_file(folder: str, name: str, default:str = '') -> str:
     try:
         file = open(os.path.join(folder, name), "r", encoding='utf-8')
@@ -59,6 +624,24 @@ def read_file(folder: str, name: str, default:str = '') -> str:
     file.close()
     return content
 
+def read_lines(folder: str, name: str) -> list:
+    try:
+        file = open(os.path.join(folder, name), "r", encoding='utf-8')
+    except:
+        return []
+    lines = [line.rstrip('\n') for line in file if line.strip() != '']
+    file.close()
+    return lines
+
+def append_line(folder: str, name: str, line: str) -> bool:
+    try:
+        file = open(os.path.join(folder, name), "a", encoding='utf-8')
+    except:
+        return False
+    file.write(line + '\n')
+    file.close()
+    return True
+
 def write_file(folder: str, name: str, content:str) -> bool:
     try:
         file = open(os.path.join(folder, name), "w", encoding='utf-8')
@@ -69,14 +652,90 @@ def write_file(folder: str, name: str, content:str) -> bool:
     return True
 
 def execute(cmd: str, quiet=False) -> bool:
-    result = subprocess.run(cmd, capture_output=quiet, shell=True)
+    result = run_command(cmd, capture_output=quiet)
     return result.returncode == 0
 
 # Returns: (success: bool, stdout: str, stderr:str)
 def execute_and_get_output(cmd: str) -> tuple:
-    result = subprocess.run(cmd, capture_output=True, text=True, shell=True)
+    result = run_command(cmd, capture_output=True, text=True)
     return result.returncode == 0, result.stdout, result.stderr
 
+# Returns: (success: bool, stdout: str, stderr:str)
+def execute_7z(args: str) -> tuple:
+    count_metric('sevenzip_spawns')
+    return execute_and_get_output(f'"{SEVENZIP_PATH}" {args}')
+
+# Aggregates a "7z l" listing line by line
+class ListingParser:
+    def __init__(self, keep_entries: bool = False):
+        self.splitters = 0
+        self.attr_column = 20 # Column positions, read from the separator line above the entries
+        self.size_column = 26
+        self.size_end = 38
+        self.compressed_end = 51
+        self.name_column = 53
+        self.volumes = -1
+        self.volume_index = -1
+        self.solid = False
+        self.file_count = 0
+        self.total_size = 0
+        self.media_size = 0
+        self.keep_entries = keep_entries
+        self.entries = [] # (name, size) of files, only with keep_entries
+        self.folders = [] # Names of folders, only with keep_entries
+
+    def feed(self, line: str):
+        if line.startswith('----------'):
+            self.splitters += 1
+            if self.splitters == 1:
+                # Columns as laid out by 7z: Date Time, Attr, Size, Compressed (blank in solid blocks), Name
+                columns = [m.span() for m in re.finditer(r'-+', line)]
+                if len(columns) >= 5:
+                    self.attr_column = columns[1][0]
+                    self.size_column, self.size_end = columns[2]
+                    self.compressed_end = columns[3][1]
+                    self.name_column = columns[-1][0]
+        elif self.splitters == 0:
+            if line.startswith('Volumes = '):
+                self.volumes = int(line[10:])
+            elif line.startswith('Volume Index = '):
+                self.volume_index = int(line[15:])
+            elif line.startswith('Solid = +'):
+                self.solid = True
+        elif self.splitters == 1:
+            match = re.match(r' *(\d+)', line[self.size_column:])
+            if line[self.attr_column] == 'D':
+                if self.keep_entries:
+                    self.folders.append(self.get_name(line, match))
+                return # Is directory
+            self.file_count += 1
+            size = int(match.group(1))
+            if self.keep_entries:
+                self.entries.append((self.get_name(line, match), size))
+            self.total_size += size
+            for ext in MEDIA_FORMATS:
+                if line.endswith(ext):
+                    self.media_size += size
+                    break
+
+    # The name starts at its column, unless sizes wider than their columns pushed it right
+    def get_name(self, line: str, size_match: re.Match) -> str:
+        shift = 0
+        if size_match is not None:
+            shift = max(0, self.size_column + size_match.end() - self.size_end)
+        pos = self.compressed_end + shift
+        while pos < len(line) and line[pos].isdigit():
+            pos += 1
+            shift += 1
+        return line[self.name_column + shift:]
+
+# Lists an archive with 7z. Returns: (success: bool, stderr: str, listing: ListingParser)
+def list_7z(file: str, password: str, keep_entries: bool = False) -> tuple:
+    count_metric('sevenzip_spawns')
+    listing = ListingParser(keep_entries)
+    returncode, stderr = run_command_lines(f'"{SEVENZIP_PATH}" l "{file}" -p"{password}"', listing.feed)
+    return returncode == 0, stderr, listing
+
 def format_bytes(size) -> str:
     power = 2**10
     n = 0
@@ -86,6 +745,33 @@ def format_bytes(size) -> str:
         n += 1
     return f'{size:.1f}{power_labels[n]}B'
 
+def get_folder_size(folder: str) -> int:
+    size = 0
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size += get_folder_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return size
+
+def get_free_space(folder: str) -> int:
+    return shutil.disk_usage(folder).free
+
+# Returns whether [needed] bytes can be written into [folder] while keeping the reserve free.
+def check_free_space(folder: str, needed: int, what: str) -> bool:
+    free = get_free_space(folder)
+    if needed + DISK_SPACE_RESERVE <= free:
+        return True
+    print(f'Not enough disk space to {what}: needs {format_bytes(needed)} (+{format_bytes(DISK_SPACE_RESERVE)} reserve), {format_bytes(free)} free on [{folder}].')
+    return False
+
 def download_mega(url: str, folder: str) -> bool:
     print('Logging out on MEGA...')
     if not execute(f'"{os.path.join(MEGACMD_FOLDER, "mega-logout")}"'):
@@ -99,6 +785,9 @@ def download_mega(url: str, folder: str) -> bool:
     if not execute(f'"{os.path.join(MEGACMD_FOLDER, "mega-ls")}" -lh'):
         return False
 
+    # Speed limit is a setting of the MEGAcmd server, set it every time so removing the cap works too
+    execute(f'"{os.path.join(MEGACMD_FOLDER, "mega-speedlimit")}" -d {BANDWIDTH_LIMITS.get("mega", 0)}', True)
+
     print('Downloading files...')
     if not execute(f'"{os.path.join(MEGACMD_FOLDER, "mega-get")}" "*" "{folder}"'):
         return False
@@ -107,10 +796,17 @@ def download_mega(url: str, folder: str) -> bool:
     return True
 
 def check_bt(bt_hash: str) -> BtInfo:
-    success, msg, err = execute_and_get_output(f'qbt torrent list --format=json')
+    info = query_bt(bt_hash)
+    if info is None:
+        exit(-1)
+    return info
+
+# Returns: same as check_bt, None if qbittorrent cli failed instead of exiting
+def query_bt(bt_hash: str) -> BtInfo:
+    success, msg, err = execute_and_get_output(f'"{QBT_PATH}" torrent list --format=json')
     if not success:
         print('Failed getting qbittorrent cli to work!')
-        exit(-1)
+        return None
     try:
         data = json.loads(msg)
         ret = BtInfo()
@@ -126,25 +822,230 @@ def check_bt(bt_hash: str) -> BtInfo:
 
     except:
         print('Qbittorrent output invalid!')
-        exit(-1)
+        return None
 
-def delete_bt(bt_hash: str) -> bool:
-    return execute(f'qbt torrent delete {bt_hash}')
+# Returns: list of (name, size) of files in the torrent, None if not available (e.g. no metadata yet)
+def get_bt_files(bt_hash: str) -> list:
+    success, msg, err = execute_and_get_output(f'"{QBT_PATH}" torrent content {bt_hash} --format=json')
+    if not success:
+        return None
+    try:
+        return [(f['name'], f['size']) for f in json.loads(msg)]
+    except:
+        return None
+
+# Sets priority of the files at [indices] of get_bt_files. priority: skip, normal, high or max
+def set_bt_file_priority(bt_hash: str, indices: list, priority: str) -> bool:
+    # One call for all files ("|" separated like the WebUI API), one call per file if the client refuses a list
+    if execute(f'"{QBT_PATH}" torrent file priority {bt_hash} "{"|".join(str(i) for i in indices)}" {priority}', True):
+        return True
+    if len(indices) == 1:
+        return False
+    for i in indices:
+        if not execute(f'"{QBT_PATH}" torrent file priority {bt_hash} {i} {priority}', True):
+            return False
+    return True
+
+# A torrent that is mostly media by size keeps only its media, archive and companion files (subtitles...).
+# Other torrents are kept whole, whatever their file count: their main content is not media (e.g. a game with a trailer).
+# Returns: indices of [files] (list of (name, size)) not worth downloading
+def classify_bt_files(files: list) -> list:
+    media = []
+    wanted = []
+    for name, size in files:
+        lower = name.lower()
+        is_media = ARCHIVE_VOLUME_PATTERN.search(lower) is not None or any(lower.endswith(ext) for ext in BT_MEDIA_FORMATS)
+        media.append(is_media)
+        wanted.append(is_media or any(lower.endswith(ext) for ext in MEDIA_COMPANION_FORMATS))
+    total_size = sum(size for name, size in files)
+    if total_size == 0:
+        return []
+    media_ratio = sum(size for (name, size), m in zip(files, media) if m) / total_size
+    if media_ratio < MEDIA_RATIO_THRESHOLD:
+        return []
+    return [i for i in range(len(files)) if not wanted[i]]
 
-def download_bt_magnet_link(magnet_link: str, folder: str) -> bool:
+def delete_bt(bt_hash: str) -> bool:
+    return execute(f'"{QBT_PATH}" torrent delete {bt_hash}')
+
+def pause_bt(bt_hash: str) -> bool:
+    return execute(f'"{QBT_PATH}" torrent pause {bt_hash}')
+
+def resume_bt(bt_hash: str) -> bool:
+    return execute(f'"{QBT_PATH}" torrent resume {bt_hash}')
+
+# Returns the info hash if url is a BT link, otherwise empty string
+def get_bt_hash(url: str) -> str:
+    if url.startswith('magnet:?xt=urn:btih:') and len(url) >= 60:
+        return url[20:60]
+    if len(url) == 40:
+        return url
+    return ''
+
+# Returns: identifier of the source behind [url], same for all links to it, '' if unknown.
+# e.g. "bt:<info hash>", "mega:<folder id>", "baidu:<surl>"
+def get_source_id(url: str) -> str:
+    url = url.strip()
+    bt_hash = get_bt_hash(url)
+    if re.fullmatch(r'[0-9A-Fa-f]{40}', bt_hash):
+        return 'bt:' + bt_hash.lower()
+    match = re.match(r'magnet:\?xt=urn:btih:([A-Za-z2-7]{32})', url)
+    if match: # Base32 info hash
+        return 'bt:' + base64.b32decode(match.group(1).upper()).hex()
+    match = re.match(r'https://mega\.nz/(folder|file)/([^#?/]+)', url)
+    if match:
+        return f'mega:{match.group(1)}:{match.group(2)}'
+    match = re.match(r'https://pan\.baidu\.com/s/1([^?#/]+)', url) or re.match(r'https://pan\.baidu\.com/share/init\?surl=([^&#]+)', url)
+    if match:
+        return 'baidu:' + match.group(1)
+    return ''
+
+download_history = None
+
+def get_download_history() -> DownloadHistory:
+    global download_history
+    if download_history is None:
+        download_history = DownloadHistory(os.path.join(WORKSPACE, HISTORY_FILE))
+    return download_history
+
+# Returns: history record of the source behind [url], None if never downloaded or unknown
+def check_history(url: str) -> dict:
+    source = get_source_id(url)
+    if source == '' or WORKSPACE == '':
+        return None
+    return get_download_history().find(source)
+
+def download_bt_magnet_link(magnet_link: str, folder: str, check_files=None, select_files=None) -> bool:
     # prefix: 20 cahrs, hash: 40 chars
     if not magnet_link.startswith('magnet:?xt=urn:btih:') or not len(magnet_link) >= 60:
         print('Invalid magnet link!')
         return False
-    return download_bt(magnet_link, magnet_link[20:60], folder)
+    return download_bt(magnet_link, magnet_link[20:60], folder, check_files, select_files)
 
-def download_bt_hash(bt_hash: str, folder: str) -> bool:
+def download_bt_hash(bt_hash: str, folder: str, check_files=None, select_files=None) -> bool:
     if len(bt_hash) != 40:
         print('Invalid bt hash!')
         return False
-    return download_bt('magnet:?xt=urn:btih:' + bt_hash, bt_hash, folder)
+    return download_bt('magnet:?xt=urn:btih:' + bt_hash, bt_hash, folder, check_files, select_files)
+
+def get_bt_marker(bt_hash: str) -> str:
+    return os.path.join(WORKSPACE, BT_HOOK_FOLDER, bt_hash.lower())
+
+# Returns: whether a task of the workspace downloads the torrent [bt_hash]
+def is_task_bt(bt_hash: str) -> bool:
+    for name in os.listdir(WORKSPACE):
+        url = read_file(os.path.join(WORKSPACE, name), URL) if not name.startswith('.') else ''
+        if url != '' and get_bt_hash(url).lower() == bt_hash.lower():
+            return True
+    return False
+
+# Run by qBittorrent when a torrent finishes: leaves a marker, and wakes the gecchi waiting for it if any.
+# Torrents of no task get no marker. Markers nobody took (e.g. the task was deleted) are removed after a day.
+def notify_bt_completed(bt_hash: str):
+    marker = get_bt_marker(bt_hash)
+    folder = os.path.dirname(marker)
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if not name.endswith('.sock') and time.time() - os.path.getmtime(path) > BT_MARKER_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+    if not is_task_bt(bt_hash):
+        return
+    os.makedirs(folder, exist_ok=True)
+    open(marker, 'w').close()
+    if hasattr(socket, 'AF_UNIX') and os.path.exists(marker + '.sock'):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b'completed', marker + '.sock')
+        except OSError:
+            pass # Waiter gone, the marker is still there
+
+# Waits for the completion hook of a torrent. Listens on a Unix socket next to the marker,
+# or where there is none (e.g. Windows, path too long), looks for the marker every BT_POLL_INTERVAL.
+class BtCompletionWaiter:
+    def __init__(self, bt_hash: str):
+        self.marker = get_bt_marker(bt_hash)
+        self.sock = None
+        os.makedirs(os.path.dirname(self.marker), exist_ok=True)
+        if hasattr(socket, 'AF_UNIX'):
+            try:
+                if os.path.exists(self.marker + '.sock'):
+                    os.remove(self.marker + '.sock') # Left by a gecchi that did not exit cleanly
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.sock.bind(self.marker + '.sock')
+            except OSError:
+                self.close()
+
+    # Returns: whether the hook reported completion within [timeout] seconds
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.take_marker():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.sock is None:
+                time.sleep(min(BT_POLL_INTERVAL, remaining))
+            elif len(select.select([self.sock], [], [], remaining)[0]) > 0:
+                self.sock.recv(64)
+        return True
+
+    def take_marker(self) -> bool:
+        try:
+            os.remove(self.marker)
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        self.take_marker()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.marker + '.sock')
+            except OSError:
+                pass
+
+# Sets gecchi as the program qBittorrent runs when a torrent finishes, through the WebUI API at QBT_URL.
+# Without QBT_URL, prints the command line to set in qBittorrent options.
+# Another program already set there is only replaced with [force].
+def install_bt_hook(force: bool) -> bool:
+    program = f'"{sys.executable}" "{os.path.abspath(__file__)}" "{os.path.abspath(WORKSPACE)}" bt-hook %I'
+    if QBT_URL == '':
+        print('QBT_URL not set. In qBittorrent options, enable "Run external program on torrent finished" with:')
+        print(program)
+        return True
+    import requests # Only needed here
+    try:
+        session = requests.Session()
+        response = session.post(f'{QBT_URL}/api/v2/auth/login', data={'username': QBT_USERNAME, 'password': QBT_PASSWORD}, timeout=10)
+        if response.text != 'Ok.':
+            print(f'Failed logging in to qBittorrent WebUI at {QBT_URL}: {response.text}')
+            return False
+        response = session.get(f'{QBT_URL}/api/v2/app/preferences', timeout=10)
+        response.raise_for_status()
+        preferences = response.json()
+        current = preferences.get('autorun_program', '')
+        if preferences.get('autorun_enabled') and current not in ['', program] and not force:
+            print(f'qBittorrent already runs a program on torrent finished: {current}')
+            print('Not replacing it. Run "bt-hook install --force" to replace it, or call gecchi from that program.')
+            return False
+        response = session.post(f'{QBT_URL}/api/v2/app/setPreferences',
+                                data={'json': json.dumps({'autorun_enabled': True, 'autorun_program': program})}, timeout=10)
+        response.raise_for_status()
+    except (requests.RequestException, ValueError) as e:
+        print(f'Failed setting qBittorrent preferences: {e}')
+        return False
+    print(f'qBittorrent runs on torrent finished: {program}')
+    print('Set GECCHI_BT_HOOK=1 to wait for it instead of polling.')
+    return True
 
-def download_bt(magnet_link: str, bt_hash: str, folder: str) -> bool:
+# check_files: optional callback getting the file list once metadata arrives, returns whether to go on downloading
+# select_files: optional callback getting the file list once metadata arrives, returns indices of files to skip
+def download_bt(magnet_link: str, bt_hash: str, folder: str, check_files=None, select_files=None) -> bool:
     # Check bt state first
     info = check_bt(bt_hash)
     if info.exist:
@@ -152,15 +1053,34 @@ def download_bt(magnet_link: str, bt_hash: str, folder: str) -> bool:
             print('File download already completed.')
             delete_bt(bt_hash)
             return True
+        if info.state.startswith('paused'):
+            print('Resuming paused bt download...')
+            resume_bt(bt_hash)
     else:
         print('Starting bt download...')
-        if not execute(f'qbt torrent add url "{magnet_link}" --folder "{folder}"'):
+        if not execute(f'"{QBT_PATH}" torrent add url "{magnet_link}" --folder "{folder}"'):
             print('Failed starting BT download.')
             return False
+    if 'bt' in BANDWIDTH_LIMITS:
+        execute(f'"{QBT_PATH}" torrent limit download {bt_hash} --set {BANDWIDTH_LIMITS["bt"]}', True)
     
     print('NOTE: BT download will run in background. You can close gecchi now and check progress later.')
+    waiter = BtCompletionWaiter(bt_hash) if BT_HOOK else None
+    try:
+        with release_resources(): # Nothing written by gecchi until the torrent completes
+            return wait_bt(bt_hash, folder, check_files, select_files, waiter)
+    finally:
+        if waiter is not None:
+            waiter.close()
+
+# Polls the torrent until metadata arrives, then until completion, or with [waiter] only waits for the hook
+def wait_bt(bt_hash: str, folder: str, check_files, select_files, waiter: BtCompletionWaiter) -> bool:
+    space_checked = False
     while True:
-        time.sleep(1.0)
+        if waiter is not None and space_checked:
+            waiter.wait(BT_SAFETY_POLL_INTERVAL)
+        else:
+            time.sleep(BT_POLL_INTERVAL)
         info = check_bt(bt_hash)
         if not info.exist:
             print('\nBT download disappeared. Please restart the task.')
@@ -169,8 +1089,41 @@ def download_bt(magnet_link: str, bt_hash: str, folder: str) -> bool:
             print('\nDownload completed.')
             delete_bt(bt_hash)
             return True
+        if not space_checked and info.size > 0: # Size is known once metadata arrives
+            space_checked = True
+            files = get_bt_files(bt_hash) if check_files is not None or select_files is not None else None
+            if files is not None and check_files is not None and not check_files(files):
+                print('Removing bt download.')
+                delete_bt(bt_hash)
+                return False
+            if files is not None and select_files is not None:
+                skipped = select_files(files)
+                if len(skipped) > 0:
+                    if set_bt_file_priority(bt_hash, skipped, 'skip'):
+                        info = check_bt(bt_hash) # Size now counts selected files only
+                    else:
+                        print('\nWarning: failed setting file priorities, downloading all files.')
+            if not check_free_space(folder, info.size - info.downloaded_size, 'download torrent'):
+                print('Pausing bt download. Free some space and run the task again.')
+                pause_bt(bt_hash)
+                return False
+            if waiter is not None:
+                print(f'Waiting for qBittorrent to report completion, progress shown every {BT_SAFETY_POLL_INTERVAL:.0f}s.')
         print(f'{info.state}|{format_bytes(info.downloaded_size)}/{format_bytes(info.size)}|{info.progress * 100:.1f}%|{format_bytes(info.speed)}/s|ETA {datetime.timedelta(seconds=info.eta)}|Active {datetime.timedelta(seconds=info.time_active)}\r', end='')
 
+BAIDU_TRANSFER_RETRIES = 3
+BAIDU_RETRY_DELAY = 5.0
+
+baidu_pan = None
+
+# One BaiDuPan for the process, it keeps verified shares so retries go straight to the transfer
+def get_baidu_pan():
+    global baidu_pan
+    if baidu_pan is None:
+        from baidu_share import BaiDuPan # Needs requests, only import when used
+        baidu_pan = BaiDuPan(BDUSS, STOKEN)
+    return baidu_pan
+
 def download_baidu(url: str, name: str, folder: str) -> bool:
     print('Making remote dir...')
     if not execute(f'bypy mkdir "{name}"'):
@@ -178,13 +1131,18 @@ def download_baidu(url: str, name: str, folder: str) -> bool:
         return False
 
     print('Transferring share...')
-    bd = BaiDuPan(BDUSS, STOKEN)
+    bd = get_baidu_pan()
     path = f'/apps/bypy/{name}/'
-    pos = url.find('?pwd=')
-    if pos != -1:
-        res = bd.saveShare(url[:pos], url[pos + 5:], path)
-    else:
-        res = bd.saveShare(url, None, path)
+    share_url, pwd = bd.splitShareUrl(url)
+    for attempt in range(BAIDU_TRANSFER_RETRIES):
+        try:
+            res = bd.saveShare(share_url, pwd, path)
+        except Exception as e: # Page parsing sometimes fails, and network errors
+            res = {'errno': 9, 'err_msg': str(e)}
+        if res['errno'] != 9 or attempt == BAIDU_TRANSFER_RETRIES - 1:
+            break
+        print(f'Transfer failed ({res["err_msg"]}), retrying...')
+        time.sleep(BAIDU_RETRY_DELAY)
     if res['errno'] != 0:
         print('Failed transferring Baidu files. Info: ' + str(res))
         return False
@@ -196,39 +1154,93 @@ def download_baidu(url: str, name: str, folder: str) -> bool:
     print('Download finished, but there might be errors.')
     return True
 
-def get_archive_info(file: str) -> ArchiveInfo:
+BAIDU_CHECK_WORKERS = 8
+
+# Checks Baidu share links concurrently without transferring anything, prints one line per link.
+# Returns: list of links still alive
+def check_baidu_links(urls: list) -> list:
+    if BDUSS == '' or STOKEN == '':
+        print('Error: "BDUSS" or "STOKEN" environment variable not set, cannot check Baidu links.')
+        return []
+    alive = []
+    for res in get_baidu_pan().checkShares(urls, BAIDU_CHECK_WORKERS):
+        if res['errno'] == 0:
+            alive.append(res['url'])
+            size = format_bytes(res['total_size']) + ('' if res['complete'] else '+')
+            print(f'[OK] {res["url"]}: {res["file_count"]} files, {size}')
+        else:
+            print(f'[{res["errno"]}: {res["err_msg"]}] {res["url"]}')
+    print(f'{len(alive)} of {len(urls)} links alive.')
+    return alive
+
+# Quick check by file content, without starting 7z.
+# False means the file is a photo or video without an appended archive, True means 7z should have a look.
+def could_be_archive(file: str) -> bool:
+    if ARCHIVE_VOLUME_PATTERN.search(file):
+        return True
+    try:
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if not any(data[offset:offset + len(sig)] == sig for offset, sig in MEDIA_HEAD_SIGNATURES):
+                    return True
+                tail = max(size - SNIFF_WINDOW, 0)
+                if size <= SNIFF_FULL_SCAN_SIZE:
+                    windows = [(0, size)]
+                else:
+                    windows = [(0, SNIFF_WINDOW), (tail, size)]
+                for start, end in windows:
+                    for sig in ARCHIVE_SIGNATURES:
+                        if data.find(sig, start, end) != -1:
+                            return True
+                for sig in ARCHIVE_TAIL_SIGNATURES:
+                    if data.find(sig, tail, size) != -1:
+                        return True
+    except (OSError, ValueError):
+        return True # Could not sniff, let 7z decide
+    return False
+
+# hints: passwords found with the content, tried first
+def get_archive_info(file: str, hints: list = None) -> ArchiveInfo:
     ret = ArchiveInfo()
-    # For now, allow any file extension
-    # match = False
-    # for format in ARCHIVE_FORMATS:
-    #     if file.endswith(format):
-    #         match = True
-    #         break
-    # if not match:
-    #     ret.is_archive = False
-    #     return ret
+    # Any file extension is allowed since archives are sometimes disguised (e.g. as .jpg),
+    # so look at the content instead.
+    if not could_be_archive(file):
+        ret.is_archive = False
+        return ret
     
-    for pswd in PASSWORDS:
-        result = subprocess.run(f'"{SEVENZIP_PATH}" l "{file}" -p"{pswd}"', capture_output=True, text=True, shell=True)
-        if result.returncode != 0:
-            if result.stderr.find('Wrong password') != -1:
+    # Listing tries count as password attempts only once 7z rejected one: archives without
+    # encrypted headers are listed on the first try whatever the password
+    rejected = 0
+    for pswd in get_password_candidates(hints):
+        success, stderr, listing = list_7z(file, pswd)
+        if not success:
+            if stderr.find('Wrong password') != -1:
+                rejected += 1
                 continue
-            if result.stderr.find('Cannot open the file as archive') != -1:
+            if stderr.find('Cannot open the file as archive') != -1:
                 ret.is_archive = False
                 return ret
             
         ret.password_matched = True
         ret.password = pswd
         break
+    if rejected > 0:
+        count_metric('password_attempts', rejected + (1 if ret.password_matched else 0))
     
     ret.is_archive = True
     if not ret.password_matched:
+        if DEFER_PASSWORDS:
+            return ret
         while True:
             pswd = input(f'Please enter password for archive [{file}], or "skip" to skip extracting: ')
             if pswd == 'skip':
                 return ret
-            result = subprocess.run(f'"{SEVENZIP_PATH}" l "{file}" -p"{pswd}"', capture_output=True, text=True, shell=True)
-            if result.returncode == 0 or result.stderr.find('Wrong password') == -1:
+            count_metric('password_attempts')
+            success, stderr, listing = list_7z(file, pswd)
+            if success or stderr.find('Wrong password') == -1:
                 print('Password correct.')
                 ret.password_matched = True
                 ret.password = pswd
@@ -236,61 +1248,56 @@ def get_archive_info(file: str) -> ArchiveInfo:
                 break
             print('Password incorrect, please try again.')
 
-    # extract info
-    lines = result.stdout.splitlines()
-    splitters = []
-    for i in range(len(lines)):
-        if lines[i].startswith('Volumes = '):
-            ret.volumes = int(lines[i][10:])
-        elif lines[i].startswith('Volume Index = '):
-            ret.volume_index = int(lines[i][15:])
-        elif lines[i].startswith('----------'):
-            splitters.append(i)
-    
-    total_size = 0
-    media_size = 0
-    if len(splitters) >= 2:
-        for i in range(splitters[0] + 1, splitters[1]):
-            if lines[i][20] == 'D':
-                continue # Is directory
-
-            ret.file_count += 1
-            size = int(lines[i][25:].split()[0])
-
-            total_size += size
-            for ext in MEDIA_FORMATS:
-                if lines[i].endswith(ext):
-                    media_size += size
-                    break
-    
-    if total_size == 0:
+    # The whole listing is needed: the ratio can swing until the last entry, and extraction needs the total size
+    ret.volumes = listing.volumes
+    ret.volume_index = listing.volume_index
+    ret.solid = listing.solid
+    ret.file_count = listing.file_count
+    ret.total_size = listing.total_size
+    if listing.total_size == 0:
         ret.media_ratio = 0
     else:
-        ret.media_ratio = media_size / total_size
+        ret.media_ratio = listing.media_size / listing.total_size
     return ret
 
-def move_all_files(src_folder: str, dest_folder: str):
-    for file in os.listdir(src_folder):
-        file_path = os.path.join(src_folder, file)
-        try:
-            shutil.move(file_path, dest_folder)
-        except:
-            dot_pos = file.rfind('.')
-            if dot_pos == -1:
-                name = file
-                ext = ''
-            else:
-                name = file[:dot_pos]
-                ext = file[dot_pos:]
+# Returns: (name, ext), where ext includes the dot
+def split_ext(file: str) -> tuple:
+    dot_pos = file.rfind('.')
+    if dot_pos == -1:
+        return file, ''
+    return file[:dot_pos], file[dot_pos:]
+
+# Moves all [paths] into [dest_folder]. The destination is listed only once and name collisions
+# are resolved in memory by appending _1, _2, ... to the name. [reserved]: names to avoid as well.
+def move_files(paths: list, dest_folder: str, reserved: set = None):
+    taken = set(os.path.normcase(f) for f in os.listdir(dest_folder))
+    taken.update(os.path.normcase(f) for f in reserved or [])
+    cross_device = False
+    for file_path in paths:
+        file = os.path.basename(file_path)
+        new_name = file
+        if os.path.normcase(new_name) in taken:
+            name, ext = split_ext(file)
             number = 1
-            while True:
-                new_name = f'{name}_{number}{ext}'
-                new_path = os.path.join(dest_folder, new_name)
-                if not os.path.exists(new_path):
-                    print(f'File already exists, renaming to [{new_name}].')
-                    shutil.move(file_path, new_path)
-                    break
+            while os.path.normcase(f'{name}_{number}{ext}') in taken:
                 number += 1
+            new_name = f'{name}_{number}{ext}'
+            print(f'File already exists, renaming to [{new_name}].')
+        taken.add(os.path.normcase(new_name))
+
+        new_path = os.path.join(dest_folder, new_name)
+        if not cross_device:
+            try:
+                os.rename(file_path, new_path)
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                cross_device = True # Remaining files are very likely on the same source device
+        shutil.move(file_path, new_path)
+
+def move_all_files(src_folder: str, dest_folder: str, reserved: set = None):
+    move_files([os.path.join(src_folder, f) for f in os.listdir(src_folder)], dest_folder, reserved)
 
 def remove_all_files(folder: str):
     if len(os.listdir(folder)) == 0:
@@ -298,43 +1305,124 @@ def remove_all_files(folder: str):
     shutil.rmtree(folder)
     os.mkdir(folder)
 
-# Returns: (success, extracted)
-def extract(file: str, folder: str, password: str, temp_folder: str) -> tuple:
+# Splits [entries] (name, size) into [count] lists of about the same total size, largest entries first
+def shard_entries(entries: list, count: int) -> list:
+    shards = [[] for i in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for name, size in sorted(entries, key=lambda e: e[1], reverse=True):
+        total, i = heapq.heappop(heap)
+        shards[i].append(name)
+        heapq.heappush(heap, (total + size, i))
+    return [shard for shard in shards if len(shard) > 0]
+
+def can_extract_parallel(info: ArchiveInfo) -> bool:
+    return EXTRACT_WORKERS > 1 and not info.solid and info.file_count > 1 and info.total_size >= PARALLEL_EXTRACT_SIZE
+
+# Extracts a non-solid archive with several 7z processes into [temp_folder], each given a list of entries.
+# Returns: False when the archive turned out solid, or anything went wrong. [temp_folder] is then left empty.
+def extract_parallel(file: str, password: str, temp_folder: str) -> bool:
+    success, stderr, listing = list_7z(file, password, True)
+    if not success or listing.solid or len(listing.entries) < 2:
+        return False
+
+    # The stage holds one cpu slot, the other processes each take a free one or are not started
+    extra_slots = []
+    workers = min(EXTRACT_WORKERS, len(listing.entries))
+    if fcntl is not None:
+        while len(extra_slots) < workers - 1:
+            slot = try_acquire_resource('cpu')
+            if slot is None:
+                break
+            extra_slots.append(slot)
+        workers = 1 + len(extra_slots)
+    if workers < 2:
+        return False
+    shards = shard_entries(listing.entries, workers)
+    print(f'Extracting with {len(shards)} processes...')
+    list_files = []
+    try:
+        for shard in shards:
+            fd, list_file = tempfile.mkstemp(suffix='.lst', dir=os.path.dirname(temp_folder))
+            list_files.append(list_file)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(shard) + '\n')
+        # -spd: entry names are matched as they are, not as wildcards
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            results = list(executor.map(lambda list_file: execute_7z(
+                f'x "{file}" -p"{password}" -o"{temp_folder}" -spd -scsUTF-8 "@{list_file}"'), list_files))
+    finally:
+        for slot in extra_slots:
+            slot.close()
+        for list_file in list_files:
+            os.remove(list_file)
+
+    if all(r[0] for r in results):
+        for folder in listing.folders:
+            os.makedirs(os.path.join(temp_folder, folder), exist_ok=True) # Empty folders are in no list
+        extracted = sum(len(file_names) for dir_path, dir_names, file_names in os.walk(temp_folder))
+        if extracted == len(listing.entries):
+            return True
+        print(f'Parallel extraction gave {extracted} of {len(listing.entries)} files, extracting again with one process.')
+    else:
+        print('Parallel extraction failed, extracting again with one process.')
+    remove_all_files(temp_folder)
+    return False
+
+# Returns: (success, extracted, deferred), deferred when the password is unknown and DEFER_PASSWORDS is set
+# on_extracted: optional callback, called once 7z finished and before files are moved out of temp
+# info: optional listing result of [file], large non-solid archives are then extracted in parallel
+# hints: passwords found with the content, tried first
+# reserved: names extracted files must not take in [folder], see move_files
+def extract(file: str, folder: str, password: str, temp_folder: str, on_extracted=None, info: ArchiveInfo = None,
+            hints: list = None, reserved: set = None) -> tuple:
+    def finish():
+        if on_extracted is not None:
+            on_extracted()
+        move_all_files(temp_folder, folder, reserved)
+
+    if info is not None and can_extract_parallel(info) and extract_parallel(file, password, temp_folder):
+        finish()
+        return True, True, False
+
     # The -aou option enables renaming for exiting file
     # Update: Not using -aou, assuming the temp folder is empty.
-    success, stdout, stderr = execute_and_get_output(f'"{SEVENZIP_PATH}" x "{file}" -p"{password}" -o"{temp_folder}"')
+    success, stdout, stderr = execute_7z(f'x "{file}" -p"{password}" -o"{temp_folder}"')
     if success:
-        move_all_files(temp_folder, folder)
-        return True, True
+        finish()
+        return True, True, False
     
     remove_all_files(temp_folder)
     if stderr.find('Wrong password') != -1:
         # This is the case when some format (like 7z) needs password on extraction but not listing.
         # We try the password list first, then prompt for a password.
-        for pswd in PASSWORDS:
-            success, stdout, stderr = execute_and_get_output(f'"{SEVENZIP_PATH}" x "{file}" -p"{pswd}" -o"{temp_folder}"')
+        for pswd in get_password_candidates(hints):
+            count_metric('password_attempts')
+            success, stdout, stderr = execute_7z(f'x "{file}" -p"{pswd}" -o"{temp_folder}"')
             if success:
-                move_all_files(temp_folder, folder)
-                return True, True
+                finish()
+                return True, True, False
             remove_all_files(temp_folder)
             if stderr.find('Wrong password') == -1:
                 print('Extraction error:')
                 print(stdout)
                 print(stderr)
-                return False, False
+                return False, False, False
                 
+        if DEFER_PASSWORDS:
+            return True, False, True
         while True:
             pswd = input(f'Please enter password for archive [{file}], or "skip" to skip extracting: ')
             if pswd == 'skip':
                 print('Skipping extraction.')
-                return True, False
+                return True, False, False
             print('Extracting...')
-            success, stdout, stderr = execute_and_get_output(f'"{SEVENZIP_PATH}" x "{file}" -p"{pswd}" -o"{temp_folder}"')
+            count_metric('password_attempts')
+            success, stdout, stderr = execute_7z(f'x "{file}" -p"{pswd}" -o"{temp_folder}"')
             if success:
                 print('Password correct, extraction success.')
                 PASSWORDS.append(pswd) # Add to global password list if success
-                move_all_files(temp_folder, folder)
-                return True, True
+                finish()
+                return True, True, False
             remove_all_files(temp_folder)
             if stderr.find('Wrong password') != -1:
                 break # Error
@@ -344,7 +1432,205 @@ def extract(file: str, folder: str, password: str, temp_folder: str) -> tuple:
     print('Extraction error:')
     print(stdout)
     print(stderr)
-    return False, False
+    return False, False, False
+
+# Returns: name of the archive set [file] belongs to, same for all its volumes
+def get_archive_set(file: str) -> str:
+    name = os.path.normcase(file)
+    for pattern, suffix in ARCHIVE_SET_PATTERNS:
+        if pattern.search(name):
+            return pattern.sub('', name) + suffix
+    return name
+
+# Adds passwords from passwords.txt of the workspace. Returns: number of new passwords
+def load_passwords() -> int:
+    added = 0
+    for pswd in read_lines(WORKSPACE, PASSWORDS_FILE):
+        if pswd not in PASSWORDS:
+            PASSWORDS.append(pswd)
+            added += 1
+    return added
+
+def add_passwords(passwords: list):
+    for pswd in passwords:
+        append_line(WORKSPACE, PASSWORDS_FILE, pswd)
+    load_passwords()
+
+# Password hints shipped with the content, e.g. "解压密码.txt" or "password.txt"
+PASSWORD_HINT_NAMES = ['password', 'passwd', 'pwd', '密码']
+PASSWORD_HINT_MAX_SIZE = 4 * 2**10
+
+# Returns: candidate passwords from hint files in [paths] (files, or folders looked into)
+def read_password_hints(paths: list) -> list:
+    candidates = []
+    walks = [os.walk(path) if os.path.isdir(path) else [(os.path.dirname(path), [], [os.path.basename(path)])] for path in paths]
+    for dir_path, dir_names, file_names in (entry for walk in walks for entry in walk):
+        for name in file_names:
+            lower = name.lower()
+            if not lower.endswith('.txt') or not any(hint in lower for hint in PASSWORD_HINT_NAMES):
+                continue
+            path = os.path.join(dir_path, name)
+            if os.path.getsize(path) > PASSWORD_HINT_MAX_SIZE:
+                continue
+            for line in read_lines(dir_path, name):
+                line = line.strip()
+                for sep in [':', '：']:
+                    if sep in line:
+                        candidates.append(line.split(sep, 1)[1].strip()) # e.g. "解压密码：xxx"
+                candidates.append(line)
+    return [c for c in dict.fromkeys(candidates) if c != '' and len(c) <= 64]
+
+# Returns: passwords to try, hints of the task first, then the global list
+def get_password_candidates(hints: list) -> list:
+    if hints is None or len(hints) == 0:
+        return PASSWORDS
+    return hints + [pswd for pswd in PASSWORDS if pswd not in hints]
+
+library_index = None
+
+# Opens the library index in the workspace, indexing category folders that were never scanned or changed
+# outside gecchi. [rescan_stale]: also rescan folders not scanned for RESCAN_INTERVAL. That walks whole
+# libraries, so it is only done when starting or idle (see refresh_library_index), never per copy.
+def get_library_index(rescan_stale: bool = False) -> LibraryIndex:
+    global library_index
+    if library_index is None:
+        library_index = LibraryIndex(os.path.join(WORKSPACE, LIBRARY_INDEX_FILE))
+    for category, folder in CATEGORIES.items():
+        if not library_index.is_scanned(folder):
+            print(f'Indexing library folder of category [{category}], later runs only pick up changes...')
+            library_index.scan(folder)
+        elif library_index.needs_scan(folder) or (rescan_stale and library_index.is_stale(folder)):
+            changed = library_index.scan(folder) # Unchanged files keep their hash, vanished ones are dropped
+            if changed > 0:
+                print(f'Indexed {changed} new or changed files in library folder of category [{category}].')
+    return library_index
+
+def refresh_library_index():
+    if DEDUP_MODE != '' or LIBRARY_CHECK != '':
+        get_library_index(True)
+
+# Copies [src] into [dest_folder], linking files whose content already exists in the library.
+# Returns: (success, saved bytes)
+def copy_with_dedup(src: str, dest_folder: str, index: LibraryIndex) -> tuple:
+    dest = os.path.join(dest_folder, os.path.basename(src))
+    saved = 0
+    try:
+        if os.path.isdir(src):
+            os.makedirs(dest, exist_ok=True)
+            for file in os.listdir(src):
+                success, file_saved = copy_with_dedup(os.path.join(src, file), dest, index)
+                saved += file_saved
+                if not success:
+                    return False, saved
+            return True, saved
+
+        duplicate, file_hash = index.find_duplicate(src)
+        if duplicate == os.path.abspath(dest):
+            return True, 0 # Same content already in place
+        if os.path.lexists(dest):
+            os.remove(dest) # Overwrite like cp does, a link cannot replace a file
+        linked = False
+        if duplicate != '':
+            start = time.perf_counter()
+            linked = link_file(duplicate, dest, DEDUP_MODE)
+            if DEDUP_MODE == 'reflink': # Done by cp, see link_file
+                record_child_command(f'cp --reflink=always "{duplicate}" "{dest}"', start, 0 if linked else 1)
+        if linked:
+            saved = os.path.getsize(src)
+        else:
+            shutil.copy2(src, dest)
+        index.add(dest, file_hash)
+        return True, saved
+    except OSError as e:
+        print(f'Failed copying [{src}]: {e}')
+        return False, saved
+
+def same_device(path_a: str, path_b: str) -> bool:
+    return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+
+# Moves [src] into [dest_folder] by renaming, merging into folders that already exist there.
+# Existing files are replaced, like the copy paths (cp, tar, copy_with_dedup) do, so both give the same library.
+# Entries the task delivered before keep their names taken in content (COPIED), so a resumed archive
+# gets _1 names there instead of replacing them. Raises OSError with EXDEV if a rename crosses devices.
+def merge_by_rename(src: str, dest_folder: str) -> bool:
+    dest = os.path.join(dest_folder, os.path.basename(src))
+    if not os.path.lexists(dest):
+        os.rename(src, dest)
+        return True
+    if os.path.isdir(src) and not os.path.islink(src):
+        if not os.path.isdir(dest) or os.path.islink(dest):
+            print(f'Cannot merge folder into [{dest}], it exists as a file.')
+            return False
+        for file in os.listdir(src):
+            if not merge_by_rename(os.path.join(src, file), dest):
+                return False
+        os.rmdir(src)
+        return True
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        print(f'Cannot replace folder [{dest}] with a file.')
+        return False
+    os.replace(src, dest)
+    return True
+
+def is_copy_packed() -> bool:
+    return 'copy' not in BANDWIDTH_LIMITS and (COPY_RECEIVER != '' or COPY_THREADS > 1)
+
+# Copies a top level content entry into [dest_folder], through the library index if deduplicating.
+# Returns: (success, saved bytes)
+def copy_entry(file_path: str, dest_folder: str, index: LibraryIndex) -> tuple:
+    if index is not None:
+        return copy_with_dedup(file_path, dest_folder, index)
+    if 'copy' in BANDWIDTH_LIMITS:
+        result = copy_throttled(file_path, dest_folder, BANDWIDTH_LIMITS['copy'])
+    elif is_copy_packed():
+        result = copy_packed([file_path], dest_folder)
+    elif os.name == 'nt':
+        result = execute(f'xcopy "{file_path}" "{dest_folder}" /E/H/Y', quiet=True)
+    else:
+        result = execute(f'cp -r "{file_path}" "{dest_folder}"', quiet=True)
+    return result, 0
+
+# Copies content entries to the category folder in a background thread, while extraction goes on.
+# Copied entries are recorded in the task folder, so the copy stage skips them.
+class CopyStreamer:
+    def __init__(self, task_folder: str, dest_folder: str):
+        self.task_folder = task_folder
+        self.dest_folder = dest_folder
+        self.queued = set(read_lines(task_folder, COPIED))
+        self.copied = 0
+        self.failed = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, file_path: str):
+        name = os.path.basename(file_path)
+        if name in self.queued:
+            return
+        self.queued.add(name)
+        self.queue.put(file_path)
+
+    def run(self):
+        # SQLite connections cannot be shared between threads
+        index = LibraryIndex(os.path.join(WORKSPACE, LIBRARY_INDEX_FILE)) if DEDUP_MODE != '' else None
+        while True:
+            file_path = self.queue.get()
+            if file_path is None:
+                break
+            success, saved = copy_entry(file_path, self.dest_folder, index)
+            if success:
+                append_line(self.task_folder, COPIED, os.path.basename(file_path))
+                self.copied += 1
+            else:
+                self.failed += 1 # Left for the copy stage
+        if index is not None:
+            index.commit()
+            index.close()
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        print(f'Copied {self.copied} entries to category folder during extraction, {self.failed} failed.')
 
 def prompt_for_category() -> str:
     categories = list(CATEGORIES.keys())
@@ -367,6 +1653,9 @@ def prompt_for_category() -> str:
         print('Invalid choice.')
 
 class Task:
+    redundant = False # Set when the library already has the content and the user chose to skip
+    lease = None # TaskLease held while running, checked before writing the status or the journal
+
     def initialize_new(self, ws, name, url, category) -> bool:
         self.folder = os.path.join(ws, name)
         self.content_folder = os.path.join(ws, name, CONTENT_FOLDER)
@@ -383,9 +1672,9 @@ class Task:
         if not os.path.exists(self.temp_folder):
             os.mkdir(self.temp_folder)
 
-        self.set_status(STATUS_UNKNOWN)
         self.set_url(url)
         self.set_category(category)
+        self.set_status(STATUS_UNKNOWN)
         return True
 
     def initialize_load(self, ws, name) -> bool:
@@ -424,6 +1713,57 @@ class Task:
         
         return True
     
+    def get_pending(self) -> list:
+        return read_lines(self.folder, PENDING)
+
+    def get_copied(self) -> set:
+        return set(read_lines(self.folder, COPIED))
+
+    def get_status_text(self) -> str:
+        text = self.status
+        pending = len(self.get_pending())
+        if pending > 0:
+            text += f', {pending} waiting for password'
+        if is_leased(self.folder):
+            lease = read_lease(self.folder) or {}
+            text += f', {lease.get("stage", "?")} by worker {lease.get("worker", "?")}'
+        return text
+
+    # Cleans up after a worker that died in the middle of a stage
+    def recover_interrupted(self):
+        # Units journaled as extracting or extracted are finished or rolled back by recover_extraction,
+        # which needs temp as it is: extracted files not moved yet only exist there
+        if any(e['state'] in ['extracting', 'extracted'] for e in self.read_journal().values()):
+            return
+        if os.path.isdir(self.temp_folder):
+            remove_all_files(self.temp_folder) # Partial extraction
+
+    # Whether passwords were added since archives were deferred
+    def can_resume_pending(self) -> bool:
+        if self.status not in [STATUS_EXTRACTED, STATUS_DONE] or len(self.get_pending()) == 0:
+            return False
+        try:
+            return os.path.getmtime(os.path.join(WORKSPACE, PASSWORDS_FILE)) > os.path.getmtime(os.path.join(self.folder, PENDING))
+        except OSError:
+            return False
+
+    # Sends deferred archives through extraction again, with the passwords known by now.
+    # Entries already copied to the category folder are marked, so copy skips them.
+    def resume_pending(self) -> bool:
+        if not self.can_resume_pending():
+            return False
+        load_passwords()
+        pending = self.get_pending()
+        print(f'Resuming {len(pending)} archive(s) waiting for a password in task [{self.name}]...')
+        if self.status == STATUS_DONE:
+            copied = set(read_lines(self.folder, COPIED))
+            for file_name in os.listdir(self.content_folder):
+                if file_name not in pending and file_name not in copied:
+                    append_line(self.folder, COPIED, file_name)
+        os.remove(os.path.join(self.folder, PENDING))
+        self.set_status(STATUS_DOWNLOADED)
+        return True
+
     def delete(self):
         if os.path.exists(self.folder):
             shutil.rmtree(self.folder)
@@ -436,9 +1776,21 @@ class Task:
         self.set_url(self.url)
         self.set_category(self.category)
 
-    def set_status(self, status):
+    def set_status(self, status, size: int = None):
+        self.check_lease()
         self.status = status
         write_file(self.folder, STATUS, status)
+        self.record_history(size)
+
+    # Keeps the download history in step with the task, it outlives the task folder
+    def record_history(self, size: int = None):
+        source = get_source_id(self.url)
+        if source == '' or WORKSPACE == '':
+            return
+        try:
+            get_download_history().record(source, self.url, self.name, self.category, self.status, size)
+        except sqlite3.Error as e:
+            print(f'Warning: failed recording download history: {e}')
 
     def set_url(self, url):
         self.url = url
@@ -453,150 +1805,577 @@ class Task:
             print(f'Archive already downloaded for task {self.name}.')
             return False
         
+        # Size is unknown before starting, only make sure the reserve is there. BT checks again once size is known.
+        if not check_free_space(self.content_folder, 0, 'download'):
+            return False
+
         # Determine type of link
         if self.url.startswith('https://mega.nz/folder/'):
-            if not download_mega(self.url, self.content_folder):
+            if not ensure_tool('mega') or not download_mega(self.url, self.content_folder):
                 return False
         elif self.url.startswith('https://pan.baidu.com/s/'):
-            if not download_baidu(self.url, self.name, self.content_folder):
+            if not ensure_tool('bypy') or not download_baidu(self.url, self.name, self.content_folder):
                 return False
         elif self.url.startswith('magnet:'):
-            if not download_bt_magnet_link(self.url, self.content_folder):
+            if not ensure_tool('qbt'):
                 return False
-        elif len(self.url) == 40:
-            if not download_bt_hash(self.url, self.content_folder):
+            if not download_bt_magnet_link(self.url, self.content_folder, self.check_library_before_download, self.select_bt_files):
+                return self.skip_if_redundant()
+        elif get_bt_hash(self.url) != '':
+            if not ensure_tool('qbt'):
                 return False
+            if not download_bt_hash(self.url, self.content_folder, self.check_library_before_download, self.select_bt_files):
+                return self.skip_if_redundant()
         else:
             print(f'Unknown URL: {self.url}')
             return False
         
-        self.set_status(STATUS_DOWNLOADED)
+        self.remove_skipped_files()
+        size = get_folder_size(self.content_folder)
+        count_metric('bytes', size)
+        self.set_status(STATUS_DOWNLOADED, size)
+        return True
+
+    # Called by download_bt once the torrent file list is known. Returns indices of files to skip.
+    def select_bt_files(self, files: list) -> list:
+        if BT_SELECT == '':
+            return []
+        skipped = classify_bt_files(files)
+        if len(skipped) == 0:
+            return []
+        size = sum(files[i][1] for i in skipped)
+        print(f'\n{len(skipped)} of {len(files)} files ({format_bytes(size)}) in task [{self.name}] are neither media nor archives, e.g. [{files[skipped[0]][0]}].')
+        if BT_SELECT == 'ask' and input('Skip downloading them? Enter "y" to skip (default downloading all): ') != 'y':
+            return []
+        write_file(self.folder, SKIPPED, '\n'.join(files[i][0] for i in skipped))
+        return skipped
+
+    # qBittorrent may still write pieces shared with wanted files, so skipped files can exist partially
+    def remove_skipped_files(self):
+        for name in read_lines(self.folder, SKIPPED):
+            path = os.path.join(self.content_folder, name)
+            for file_path in [path, path + '.!qB']: # Incomplete files may keep the qBittorrent extension
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+            folder = os.path.dirname(path)
+            while folder != self.content_folder and os.path.isdir(folder) and len(os.listdir(folder)) == 0:
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+    # Asks (or decides by LIBRARY_CHECK mode) whether to skip the task. [matches] holds the library path
+    # matching each file of the task, or '' for files not found.
+    def confirm_redundant(self, matches: list) -> bool:
+        found = [m for m in matches if m != '']
+        if len(found) == 0:
+            return False
+        folders = sorted(set(os.path.dirname(m) for m in found))
+        if len(found) < len(matches):
+            print(f'Note: {len(found)} of {len(matches)} files of task [{self.name}] already exist in the library, e.g. in [{folders[0]}].')
+            return False
+        print(f'All {len(matches)} files of task [{self.name}] already exist in the library, in {len(folders)} folder(s), e.g. [{folders[0]}].')
+        if LIBRARY_CHECK == 'skip':
+            skip = True
+        else:
+            skip = input('Skip this task? Enter "y" to skip (default continuing): ') == 'y'
+        if skip:
+            self.redundant = True
+        return skip
+
+    # Called by download_bt once the torrent file list is known. Returns whether to go on downloading.
+    def check_library_before_download(self, files: list) -> bool:
+        if LIBRARY_CHECK == '':
+            return True
+        index = get_library_index()
+        return not self.confirm_redundant([index.find_by_name_size(name, size) for name, size in files if size >= DEDUP_MIN_SIZE])
+
+    def check_library_before_copy(self, dest_folder: str) -> bool:
+        if LIBRARY_CHECK == '':
+            return True
+        index = get_library_index()
+        matches = []
+        for dir_path, dir_names, file_names in os.walk(self.content_folder):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if os.path.getsize(path) >= DEDUP_MIN_SIZE:
+                    matches.append(index.find_duplicate(path, dest_folder)[0])
+        index.commit() # Keep hashes computed for candidates
+        return not self.confirm_redundant(matches)
+
+    def skip_if_redundant(self) -> bool:
+        if not self.redundant:
+            return False
+        print(f'Skipped task [{self.name}], content already in library.')
+        self.set_status(STATUS_DONE)
         return True
         
     def extract(self) -> bool:
         if self.status != STATUS_DOWNLOADED:
             print(f'Cannot perform extract when status is [{self.status}].')
             return False
-        
+        if not ensure_tool('7z'):
+            return False
+
+        streamer = self.start_streamer() if PIPELINE else None
+        self.journal_file = open(os.path.join(self.folder, JOURNAL), 'a', encoding='utf-8')
+        try:
+            success = self.extract_content(streamer)
+        finally:
+            self.journal_file.close()
+            if streamer is not None:
+                streamer.finish()
+        if self.status == STATUS_EXTRACTED:
+            os.remove(os.path.join(self.folder, JOURNAL))
+        return success
+
+    # States of a content file: probed (info known), extracting (7z writing into temp),
+    # extracted (temp complete), moved (extracted files in content, archive still there), removed.
+    def write_journal(self, file_name: str, state: str, info: ArchiveInfo = None):
+        self.check_lease()
+        record = {'file': file_name, 'state': state}
+        if info is not None:
+            record['info'] = asdict(info)
+        self.journal_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.journal_file.flush()
+
+    # Returns: file name -> {'state', 'info'} of files with a live journal record
+    def read_journal(self) -> dict:
+        journal = {}
+        for line in read_lines(self.folder, JOURNAL):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Cut short by a crash
+            if record['state'] == 'removed':
+                journal.pop(record['file'], None)
+                continue
+            entry = journal.setdefault(record['file'], {})
+            entry['state'] = record['state']
+            if 'info' in record:
+                entry['info'] = ArchiveInfo(**record['info'])
+        return journal
+
+    # Finishes or rolls back the unit an earlier run was in the middle of.
+    # Returns: the journal to go on with
+    def recover_extraction(self) -> dict:
+        single_folder_path = os.path.join(self.content_folder, '_SINGLE_FOLDER_')
+        if os.path.isdir(single_folder_path):
+            print('Finishing expanding single folder...')
+            move_all_files(single_folder_path, self.content_folder)
+            shutil.rmtree(single_folder_path)
+
+        journal = self.read_journal()
+        for file_name, entry in journal.items():
+            if entry['state'] == 'extracting':
+                print(f'Extraction of [{file_name}] was interrupted, starting it again.')
+                remove_all_files(self.temp_folder)
+                entry['state'] = 'probed'
+            elif entry['state'] == 'extracted':
+                print(f'Finishing moving extracted files of [{file_name}]...')
+                move_all_files(self.temp_folder, self.content_folder, self.get_copied())
+                self.write_journal(file_name, 'moved')
+                entry['state'] = 'moved'
+        if len(journal) > 0:
+            done = len([e for e in journal.values() if e['state'] == 'moved'])
+            print(f'Resuming extraction: {len(journal)} files already probed, {done} archives already extracted.')
+        return journal
+
+    def extract_content(self, streamer: CopyStreamer) -> bool:
+        final = set() # Files that stay in content as they are, no need to probe them again
+        journal = self.recover_extraction()
+        hints = [] # Passwords found with this content, tried before the global list
+        hint_scanned = set() # Content entries already looked into for hints
+        copied = self.get_copied()
         while True:
             files = os.listdir(self.content_folder)
 
-            # Handle single folder case
-            if len(files) == 1:
+            # Handle single folder case, unless entries were already moved out to the category folder
+            if len(files) == 1 and copied <= set(files):
                 single_folder_path = os.path.join(self.content_folder, files[0])
                 if os.path.isdir(single_folder_path):
                     print(f'Expanding single folder [{files[0]}]...')
                     p = os.path.join(self.content_folder, '_SINGLE_FOLDER_')
-                    shutil.move(single_folder_path, p) # rename folder, to avoid the inner files have same name
-                    for f in os.listdir(p):
-                        shutil.move(os.path.join(p, f), self.content_folder)
+                    os.rename(single_folder_path, p) # rename folder, to avoid the inner files have same name
+                    move_all_files(p, self.content_folder)
                     shutil.rmtree(p)
                     continue # Go to next iteration
 
+            # Hints of this task only, looked for once in each new entry (e.g. extracted by the last pass)
+            new_entries = [f for f in files if f not in hint_scanned]
+            hint_scanned.update(new_entries)
+            for pswd in read_password_hints([os.path.join(self.content_folder, f) for f in new_entries]):
+                if pswd not in hints:
+                    print(f'Found password hint [{pswd}].')
+                    hints.insert(0, pswd) # Most likely the one for this content
+            
             files_extracted = False
             to_remove = []
+            deferred = set() # Archive sets waiting for a password
             for file_name in files:
+                if file_name in final:
+                    continue
                 file_path = os.path.join(self.content_folder, file_name)
                 if os.path.isfile(file_path):
-                    info = get_archive_info(file_path)
-                    if info.is_archive:
-                        if not info.password_matched:
-                            print(f'Skipping extracting archive [{file_name}]. Password unknown.')
-                            continue
-                        if info.media_ratio < MEDIA_RATIO_THRESHOLD and info.file_count > ARCHIVE_FILECOUNT_THRESHOLD:
-                            print(f'Not extracting [{file_name}], media ratio {info.media_ratio * 100:.1f}%, file count {info.file_count}')
+                    entry = journal.pop(file_name, {})
+                    if entry.get('state') == 'moved':
+                        to_remove.append(file_path) # Extracted before an interruption
+                        files_extracted = True
+                        continue
+                    info = entry.get('info')
+                    if info is None or (info.is_archive and not info.password_matched): # Passwords may be known by now
+                        info = get_archive_info(file_path, hints)
+                        self.write_journal(file_name, 'probed', info)
+                    if not info.is_archive:
+                        final.add(file_name)
+                        continue
+                    if not info.password_matched:
+                        if DEFER_PASSWORDS:
+                            print(f'Deferring archive [{file_name}]. Password unknown.')
+                            deferred.add(get_archive_set(file_name))
+                            final.add(file_name)
                             continue
-                        to_remove.append(file_path)
-                        if info.volume_index > 0:
-                            continue
-                        print(f'Extracting [{file_name}], media ratio {info.media_ratio * 100:.1f}%, file count {info.file_count}...')
-                        success, extracted = extract(file_path, self.content_folder, info.password, self.temp_folder)
-                        if not success:
-                            print(f'Failed extracting file [{file_name}].')
-                            return False
-                        if extracted:
-                            files_extracted = True
+                        print(f'Skipping extracting archive [{file_name}]. Password unknown.')
+                        continue
+                    if info.media_ratio < MEDIA_RATIO_THRESHOLD and info.file_count > ARCHIVE_FILECOUNT_THRESHOLD:
+                        print(f'Not extracting [{file_name}], media ratio {info.media_ratio * 100:.1f}%, file count {info.file_count}')
+                        final.add(file_name)
+                        continue
+                    to_remove.append(file_path)
+                    if info.volume_index > 0:
+                        continue
+                    if not check_free_space(self.temp_folder, info.total_size, f'extract [{file_name}]'):
+                        return False
+                    print(f'Extracting [{file_name}], media ratio {info.media_ratio * 100:.1f}%, file count {info.file_count}...')
+                    self.write_journal(file_name, 'extracting')
+                    success, extracted, password_pending = extract(file_path, self.content_folder, info.password, self.temp_folder,
+                                                                   lambda: self.write_journal(file_name, 'extracted'), info, hints, copied)
+                    if not success:
+                        print(f'Failed extracting file [{file_name}].')
+                        return False
+                    self.write_journal(file_name, 'moved' if extracted else 'probed')
+                    if password_pending:
+                        print(f'Deferring archive [{file_name}]. Password unknown.')
+                        deferred.add(get_archive_set(file_name))
+                    if extracted:
+                        files_extracted = True
+                        count_metric('bytes', info.total_size)
             
+            # Deferred archives stay in content with all their volumes
+            kept = [f for f in to_remove if get_archive_set(os.path.basename(f)) in deferred]
+            to_remove = [f for f in to_remove if f not in kept]
+            final.update(os.path.basename(f) for f in kept)
+            pending = self.get_pending()
+            for file_name in files:
+                if file_name in final and get_archive_set(file_name) in deferred and file_name not in pending:
+                    append_line(self.folder, PENDING, file_name)
+            move_files(to_remove, self.folder) # Move to outer side rather than deleting
             for file_path in to_remove:
-                #os.remove(file_path)
-                shutil.move(file_path, self.folder) # Move to outer side rather than deleting
+                self.write_journal(os.path.basename(file_path), 'removed')
+            if streamer is not None:
+                self.stream_final(streamer, final)
             if not files_extracted:
                 self.set_status(STATUS_EXTRACTED)
                 return True
-            
-    def copy(self):
-        if self.status != STATUS_EXTRACTED:
-            print(f'Cannot perform copy when status is [{self.status}].')
-            return False
-        
+
+    # Returns: list of entries left to copy, because renaming crossed devices after all. None on failure.
+    def finalize_by_rename(self, files: list, dest_folder: str) -> list:
+        for i in range(len(files)):
+            try:
+                if not merge_by_rename(os.path.join(self.content_folder, files[i]), dest_folder):
+                    print(f'Failed moving [{files[i]}].')
+                    return None
+                append_line(self.folder, COPIED, files[i]) # Gone from content, its name stays taken there
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    print(f'Failed moving [{files[i]}]: {e}')
+                    return None
+                print('Rename crosses devices, copying the rest.')
+                return files[i:] # Copying merges the part not moved yet
+        return []
+
+    def start_streamer(self) -> CopyStreamer:
+        if LIBRARY_CHECK != '':
+            print('Note: not copying during extraction, the library check needs the whole content first.')
+            return None
+        dest_folder = self.get_dest_folder()
+        if dest_folder == '' or not self.ensure_dest_folder(dest_folder):
+            return None
+        if DEDUP_MODE == '' and same_device(self.content_folder, dest_folder):
+            return None # Copy stage only renames, nothing to overlap
+        print('Final files will be copied to category folder during extraction.')
+        return CopyStreamer(self.folder, dest_folder)
+
+    def stream_final(self, streamer: CopyStreamer, final: set):
+        pending = set(self.get_pending())
+        final = final - pending
+        for file_name in final:
+            streamer.add(os.path.join(self.content_folder, file_name))
+        # A folder left alone in content would be expanded, so folders are only final next to another final entry
+        folders = [f for f in os.listdir(self.content_folder) if os.path.isdir(os.path.join(self.content_folder, f))]
+        if len(final) + len(folders) >= 2:
+            for folder in folders:
+                streamer.add(os.path.join(self.content_folder, folder))
+
+    # Returns: task folder in its category, '' if category not exist
+    def get_dest_folder(self) -> str:
         category_folder = CATEGORIES.get(self.category, '')
         if category_folder == '':
             print(f'Category not exist: {self.category}')
-            return False
-        
-        dest_folder = os.path.join(category_folder, self.name)
+            return ''
+        return os.path.join(category_folder, self.name)
+
+    def ensure_dest_folder(self, dest_folder: str) -> bool:
         if not os.path.exists(dest_folder):
+            if DEDUP_MODE == '' and LIBRARY_CHECK == '':
+                os.mkdir(dest_folder)
+                return True
+            index = get_library_index() # Up to date before the category folder changes
+            category_folder = os.path.dirname(dest_folder)
+            mtime = os.stat(category_folder).st_mtime_ns
             os.mkdir(dest_folder)
+            index.update_root(category_folder, mtime) # Not an outside change to rescan for
         elif not os.path.isdir(dest_folder):
             print(f'Name already exists as a file: {dest_folder}')
             return False
+        return True
+
+    def copy(self):
+        if self.status != STATUS_EXTRACTED:
+            print(f'Cannot perform copy when status is [{self.status}].')
+            return False
         
-        print('Copying files to category folder...')
-        for file in os.listdir(self.content_folder):
+        dest_folder = self.get_dest_folder()
+        if dest_folder == '':
+            return False
+        
+        if not self.check_library_before_copy(dest_folder):
+            return self.skip_if_redundant()
+
+        if not self.ensure_dest_folder(dest_folder):
+            return False
+        
+        copied = self.get_copied() # Already copied during extraction, or moved
+        pending = set(self.get_pending()) # Waiting for a password
+        files = [f for f in os.listdir(self.content_folder) if f not in copied and f not in pending]
+        if len(copied) > 0:
+            print(f'{len(copied)} entries already copied.')
+        if len(pending) > 0:
+            print(f'{len(pending)} archive(s) waiting for a password, not copied.')
+        content_size = 0
+        for file in files:
             file_path = os.path.join(self.content_folder, file)
+            content_size += get_folder_size(file_path) if os.path.isdir(file_path) else os.path.getsize(file_path)
+
+        if DEDUP_MODE == '' and same_device(self.content_folder, dest_folder):
+            # No data to write, the task folder is usually deleted afterwards anyway
+            print('Category folder is on the same device, moving files...')
+            files = self.finalize_by_rename(files, dest_folder)
+            if files is None:
+                return False
+            if len(files) == 0:
+                count_metric('bytes', content_size)
+                print('Finished moving files.')
+                if library_index is not None or LIBRARY_CHECK != '':
+                    get_library_index().scan(dest_folder)
+                self.set_status(STATUS_DONE)
+                return True
+            content_size = 0
+            for file in files:
+                file_path = os.path.join(self.content_folder, file)
+                content_size += get_folder_size(file_path) if os.path.isdir(file_path) else os.path.getsize(file_path)
+
+        if not check_free_space(dest_folder, content_size, 'copy to category folder'):
+            return False
+
+        print('Copying files to category folder...')
+        index = get_library_index() if DEDUP_MODE != '' else None
+        saved = 0
+        if index is None and is_copy_packed():
+            # One tar stream and one thread pool for all entries, loose small files are the common case
+            if not copy_packed([os.path.join(self.content_folder, file) for file in files], dest_folder):
+                print('Failed copying files.')
+                return False
+            files = []
+        for file in files:
             #print(f'Copying [{file}]...')
-            if os.name == 'nt':
-                result = execute(f'xcopy "{file_path}" "{dest_folder}" /E/H/Y', quiet=True)
-            else:
-                result = execute(f'cp -r "{file_path}" "{dest_folder}"', quiet=True)
-            if not result:
+            success, file_saved = copy_entry(os.path.join(self.content_folder, file), dest_folder, index)
+            saved += file_saved
+            if not success:
+                if index is not None:
+                    index.commit()
                 print(f'Failed copying [{file}].')
                 return False
-        print(f'Finished copying files.')
+        count_metric('bytes', content_size - saved)
+        if index is not None:
+            index.commit()
+            print(f'Finished copying files. Deduplication saved {format_bytes(saved)}.')
+        else:
+            print(f'Finished copying files.')
+            if library_index is not None or LIBRARY_CHECK != '':
+                get_library_index().scan(dest_folder) # Keep the library index up to date
             
         self.set_status(STATUS_DONE)
         return True
     
-    def run(self) -> bool:
+    # Returns: (folder written by next stage, estimated bytes), folder is '' if nothing to do
+    def estimate_next_stage(self) -> tuple:
         if self.status == STATUS_UNKNOWN:
-            return self.download() and self.extract() and self.copy()
+            bt_hash = get_bt_hash(self.url)
+            if bt_hash != '' and probe_tool('qbt'):
+                info = query_bt(bt_hash) # Planning goes on without qbittorrent, the download stage reports it
+                if info is not None and info.exist and info.size > 0:
+                    return self.content_folder, max(info.size - info.downloaded_size, 0)
+            return self.content_folder, 0 # Unknown before download starts
         elif self.status == STATUS_DOWNLOADED:
-            return self.extract() and self.copy()
+            # Archives are kept after extraction, assume media barely compresses
+            return self.temp_folder, get_folder_size(self.content_folder)
         elif self.status == STATUS_EXTRACTED:
-            return self.copy()
-        elif self.status == STATUS_DONE:
-            return True
-        else:
+            category_folder = CATEGORIES.get(self.category, '')
+            if category_folder == '':
+                return '', 0
+            return category_folder, get_folder_size(self.content_folder)
+        return '', 0
+
+    # Another worker took the task over after our heartbeat stalled: it may be extracting into the same temp folder
+    def check_lease(self):
+        if self.lease is not None and not self.lease.is_held():
+            raise LeaseLost(f'Task [{self.name}] was taken over by another worker')
+
+    def release_lease(self):
+        if self.lease is not None:
+            self.lease.release()
+            self.lease = None
+
+    def run(self) -> bool:
+        try:
+            self.resume_pending()
+        except LeaseLost as e:
+            print(f'{e}, stopping.')
             return False
+        # A stage may finish the task early (e.g. skipped as redundant), so follow the status
+        while self.status != STATUS_DONE:
+            if not self.run_one_stage():
+                return False
+        return True
         
+    # Runs one stage function and records its metrics
+    def run_stage(self, stage: str, func) -> bool:
+        global current_metrics
+        current_metrics = StageMetrics(task=self.name, stage=stage, category=self.category, started=time.time())
+        start = time.perf_counter()
+        success = False
+        profiler = cProfile.Profile() if PROFILE else None
+        try:
+            with use_resources(STAGE_RESOURCES.get(stage, [])):
+                if profiler is not None:
+                    success = profiler.runcall(func)
+                else:
+                    success = func()
+        except LeaseLost as e:
+            print(f'{e}, stopping.')
+        finally:
+            metrics = current_metrics
+            current_metrics = None
+            if profiler is not None:
+                stage_profiles.append((stage, time.perf_counter() - start, profiler))
+            metrics.success = success
+            metrics.seconds = time.perf_counter() - start
+            if metrics.seconds > 0:
+                metrics.throughput = metrics.bytes / metrics.seconds
+            try:
+                record_metrics(metrics)
+            except OSError as e:
+                print(f'Warning: failed writing metrics: {e}')
+        return success
+
     def run_one_stage(self) -> bool:
         if self.status == STATUS_UNKNOWN:
-            return self.download()
+            return self.run_stage('download', self.download)
         elif self.status == STATUS_DOWNLOADED:
-            return self.extract()
+            return self.run_stage('extract', self.extract)
         elif self.status == STATUS_EXTRACTED:
-            return self.copy()
+            return self.run_stage('copy', self.copy)
         elif self.status == STATUS_DONE:
             return True
         else:
             return False
 
-# Returns whether need again
-def ensure_executables() -> bool:
-    if not execute(f'{SEVENZIP_PATH}', True):
-        print(f'Error: 7z executable ({SEVENZIP_PATH}) not available. You may set 7z path in SEVENZIP_PATH environment variable.')
+# Returns: (program, probe arguments) of an external tool
+def get_tool_command(tool: str) -> tuple:
+    if tool == '7z':
+        return SEVENZIP_PATH, ''
+    if tool == 'mega':
+        return os.path.join(MEGACMD_FOLDER, 'mega-help'), ''
+    if tool == 'qbt':
+        return QBT_PATH, ''
+    if tool == 'bypy':
+        return 'bypy', '-h'
+    raise ValueError(f'Unknown tool: {tool}')
+
+def get_tool_error(tool: str) -> str:
+    if tool == '7z':
+        return f'Error: 7z executable ({SEVENZIP_PATH}) not available. You may set 7z path in SEVENZIP_PATH environment variable.'
+    if tool == 'mega':
+        return f'Error: MEGAcmd not found (current folder: {MEGACMD_FOLDER}). Mega links cannot work. You may set MEGAcmd folder in MEGACMD_FOLDER environment variable.'
+    if tool == 'qbt':
+        return f'Error: qbt ({QBT_PATH}) not found. Magnet links cannot work. You may set qbt path in QBT_PATH environment variable.'
+    return 'Error: bypy not found. Baidu share links cannot work.'
+
+tool_status = {} # Probe results of this process
+
+def read_tools_cache() -> dict:
+    if WORKSPACE == '':
+        return {}
+    try:
+        with open(os.path.join(WORKSPACE, TOOLS_CACHE_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_tools_cache(cache: dict):
+    if WORKSPACE == '':
+        return
+    path = os.path.join(WORKSPACE, TOOLS_CACHE_FILE)
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass # Only a cache
+
+# Returns whether an external tool works. A working tool is started at most once per binary:
+# success is cached in the workspace until the binary is replaced. Failures are not cached, they often
+# have outside causes (a missing Python package for bypy, a broken PATH entry) the user then fixes.
+def probe_tool(tool: str) -> bool:
+    if tool in tool_status:
+        return tool_status[tool]
+    program, args = get_tool_command(tool)
+    path = shutil.which(program)
+    if path is None:
+        tool_status[tool] = False # Not installed, nothing to start
         return False
-    
-    if not execute(f'{os.path.join(MEGACMD_FOLDER, "mega-help")}', True):
-        print(f'Warning: MEGAcmd not found (current folder: {MEGACMD_FOLDER}). Mega links cannot work. You may set MEGAcmd folder in MEGACMD_FOLDER environment variable.')
-    
-    if not execute('qbt', True):
-        print('Warning: qbt not found. Magnet links cannot work.')
-    
-    if not execute('bypy -h', True):
-        print('Warning: bypy not found. Baidu share links cannot work.')
-    
-    return True
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cache = read_tools_cache()
+    entry = cache.get(tool)
+    if entry is not None and entry.get('path') == path and entry.get('mtime') == mtime and entry.get('ok'):
+        tool_status[tool] = True
+        return True
+
+    ok = execute(f'"{path}" {args}', True)
+    tool_status[tool] = ok
+    if ok:
+        cache[tool] = {'path': path, 'mtime': mtime, 'ok': True}
+    elif cache.pop(tool, None) is None:
+        return ok
+    write_tools_cache(cache)
+    return ok
+
+# Probes a tool when a task first needs it, printing an error if it is not available
+def ensure_tool(tool: str) -> bool:
+    if probe_tool(tool):
+        return True
+    print(get_tool_error(tool))
+    return False
 
 def read_categories() -> bool:
     file_path = os.path.join(WORKSPACE, 'categories.txt')
@@ -628,10 +2407,27 @@ def read_categories() -> bool:
     print(f'Successfully read {len(CATEGORIES)} categories.')
     return True
 
+# Leases [task] for running it from this process, so workers leave it alone meanwhile.
+# Returns: the lease, None if a worker holds it. The task is reloaded, a worker may have moved it on.
+def lease_task(task: Task) -> TaskLease:
+    lease = TaskLease(task.folder, get_worker_id(), WORKER_STAGES.get(task.status, 'run'))
+    if not lease.try_acquire():
+        holder = read_lease(task.folder) or {}
+        print(f'Task [{task.name}] is being run by worker {holder.get("worker", "?")} ({holder.get("stage", "?")}). Try again later.')
+        return None
+    if lease.previous is not None:
+        print(f'Took over task [{task.name}] from stale worker {lease.previous.get("worker", "?")}.')
+        task.recover_interrupted()
+    if not task.initialize_load(WORKSPACE, task.name):
+        lease.release()
+        return None
+    task.lease = lease
+    return lease
+
 def task_operations(task: Task) -> bool:
     print('==============================================')
     print(f'Selected task: {task.name}')
-    print(f'Status: {task.status}')
+    print(f'Status: {task.get_status_text()}')
     print(f'URL: {task.url}')
     print(f'Category: {task.category}')
     print('')
@@ -657,8 +2453,18 @@ def task_operations(task: Task) -> bool:
 
     text = input('Select one option (1 ~ 8), default 1 (Run/Resume): ')
     if text == '1' or text == '':
-        if task.run():
+        lease = lease_task(task)
+        if lease is None:
+            return True
+        try:
+            success = task.run()
+        finally:
+            task.release_lease()
+        if success:
             print('Gecchi success!')
+            if len(task.get_pending()) > 0:
+                print(f'{len(task.get_pending())} archive(s) wait for a password, task preserved. Add passwords with the "password" command.')
+                return True
             if input('Do you want to retain temp files? Enter "y" to retain (default not retaining): ') == 'y':
                 print('Task preserved.')
                 return True
@@ -670,7 +2476,14 @@ def task_operations(task: Task) -> bool:
             print(f'Running failed. Status: {task.status}. Please check logs and temp files.')
             return True
     elif text == '2':
-        if task.run_one_stage():
+        lease = lease_task(task)
+        if lease is None:
+            return True
+        try:
+            success = task.run_one_stage()
+        finally:
+            task.release_lease()
+        if success:
             print('Gecchi one stage success.')
         else:
             print('Gecchi one stage failed. Please check logs and temp files.')
@@ -709,6 +2522,9 @@ def task_operations(task: Task) -> bool:
         else:
             print('Cancel setting status.')
             return True
+    elif text in ['6', '7'] and is_leased(task.folder):
+        print(f'Task [{task.name}] is being run by a worker. Try again later.')
+        return True
     elif text == '6':
         if input('This will remove all current temp files and reset state. Confirm? (y/N): ') == 'y':
             task.reset()
@@ -731,9 +2547,413 @@ def task_operations(task: Task) -> bool:
         print('Unknown choice.')
         return True
 
+# Orders tasks so that their next stages fit the free space of each filesystem.
+# Returns: (admitted tasks in running order, deferred tasks)
+def plan_tasks(tasks: list) -> tuple:
+    estimates = []
+    for task in tasks:
+        folder, size = task.estimate_next_stage()
+        if folder == '':
+            continue
+        estimates.append((size, task, folder))
+    estimates.sort(key=lambda e: e[0]) # Small stages first, so more tasks make progress
+
+    budgets = {} # device -> bytes still available
+    admitted = []
+    deferred = []
+    for size, task, folder in estimates:
+        device = os.stat(folder).st_dev
+        if device not in budgets:
+            budgets[device] = get_free_space(folder) - DISK_SPACE_RESERVE
+        if size <= budgets[device]:
+            budgets[device] -= size
+            admitted.append(task)
+        else:
+            print(f'Deferring task [{task.name}] ({task.status}): needs {format_bytes(size)} on [{folder}].')
+            deferred.append(task)
+    return admitted, deferred
+
+# Runs stages of all unfinished tasks, ordered by the capacity plan and re-planned after each round.
+def run_all_tasks(tasks: list, delete_done: bool):
+    refresh_library_index()
+    tasks = [task for task in tasks if not is_leased(task.folder)] # Taken by workers
+    for task in tasks:
+        task.resume_pending()
+    pending = [task for task in tasks if task.status != STATUS_DONE]
+    while len(pending) > 0:
+        admitted, deferred = plan_tasks(pending)
+        if len(admitted) == 0:
+            print(f'{len(deferred)} task(s) cannot fit into free space. Stopping.')
+            break
+        for task in admitted:
+            lease = lease_task(task)
+            if lease is None:
+                pending.remove(task) # Taken by a worker meanwhile
+                continue
+            try:
+                print('==============================================')
+                print(f'Running stage of task [{task.name}] ({task.status})...')
+                success = task.run_one_stage()
+            finally:
+                task.release_lease()
+            if not success:
+                print(f'Task [{task.name}] failed at status [{task.status}].')
+                pending.remove(task)
+                continue
+            if task.status == STATUS_DONE:
+                print(f'Task [{task.name}] done.')
+                pending.remove(task)
+                if delete_done and len(task.get_pending()) == 0:
+                    task.delete()
+    print('Finished running all tasks.')
+
+# Nobody answers prompts of workers or intake, [who] runs without a human
+def set_unattended(who: str):
+    global DEFER_PASSWORDS, LIBRARY_CHECK, BT_SELECT
+    DEFER_PASSWORDS = True
+    if LIBRARY_CHECK == 'warn':
+        print(f'Note: {who} do not ask, GECCHI_LIBRARY_CHECK=warn only reports redundant tasks.')
+        LIBRARY_CHECK = ''
+    if BT_SELECT == 'ask':
+        print(f'Note: {who} do not ask, GECCHI_BT_SELECT=ask downloads all torrent files.')
+        BT_SELECT = ''
+
+WORKER_STAGES = {STATUS_UNKNOWN: 'download', STATUS_DOWNLOADED: 'extract', STATUS_EXTRACTED: 'copy'}
+WORKER_POLL_INTERVAL = 10.0
+
+# Claims stages of tasks in the workspace, alongside other workers on this or other machines.
+# Each stage runs under a lease of the task folder, see TaskLease.
+def run_worker(stages: list, exit_when_done: bool):
+    set_unattended('workers')
+    worker = get_worker_id()
+    print(f'Worker [{worker}] running stages: {", ".join(stages)}')
+    failed = {} # Task name -> status it failed at, not retried by this worker until the status changes
+    while True:
+        worked = False
+        unfinished = 0
+        for task in get_current_tasks():
+            if task.status == STATUS_DONE and not task.can_resume_pending():
+                continue
+            if failed.get(task.name) == task.status:
+                continue
+            unfinished += 1
+            stage = WORKER_STAGES.get(task.status)
+            if stage not in stages and not task.can_resume_pending():
+                continue
+            lease = TaskLease(task.folder, worker, stage)
+            if not lease.try_acquire():
+                continue
+            try:
+                if lease.previous is not None:
+                    print(f'Took over task [{task.name}] from stale worker {lease.previous.get("worker", "?")}.')
+                    task.recover_interrupted()
+                name = task.name
+                task = Task() # Reload, the status may have changed since listing
+                if not task.initialize_load(WORKSPACE, name):
+                    continue
+                task.lease = lease
+                task.resume_pending()
+                stage = WORKER_STAGES.get(task.status)
+                if stage not in stages:
+                    continue # Another worker got there first
+                print('==============================================')
+                print(f'Running stage [{stage}] of task [{task.name}]...')
+                if task.run_one_stage():
+                    worked = True
+                else:
+                    print(f'Task [{task.name}] failed at status [{task.status}].')
+                    failed[task.name] = task.status
+            except LeaseLost as e:
+                print(f'{e}, stopping.')
+            finally:
+                lease.release()
+        if not worked:
+            if exit_when_done and unfinished == 0:
+                print('All tasks finished.')
+                return
+            refresh_library_index()
+            time.sleep(WORKER_POLL_INTERVAL)
+
+INTAKE_DEFAULT_FOLDER = '.intake'
+INTAKE_DONE_FOLDER = '.done' # Torrent and link files tasks were created from
+INTAKE_REJECTED_FOLDER = '.rejected' # Items no task was created from
+INTAKE_SETTLE = 2.0 # Seconds an item must stay unchanged before intake, unless it was closed after writing or moved in
+INTAKE_POLL_INTERVAL = 2.0 # Only when inotify is unavailable
+INTAKE_PARTIAL_SUFFIXES = ['.part', '.partial', '.crdownload', '.download', '.tmp', '.!qb']
+INTAKE_LINK_SUFFIXES = ['.txt', '.url', '.magnet']
+INTAKE_LINK_MAX_SIZE = 64 * 2**10 # Larger text files are taken as finished downloads
+# Only links Task.download handles: mega folders, Baidu shares, magnets and bare info hashes (alone on a line,
+# so checksum lists are not taken for torrents)
+INTAKE_URL_PATTERN = re.compile(r'https://mega\.nz/folder/\S+|https://pan\.baidu\.com/s/\S+|magnet:\?xt=urn:btih:\S+|^[0-9A-Fa-f]{40}$')
+
+# Decodes the bencoded value at [pos] of [data]. Returns: (value, position after it)
+def bdecode(data: bytes, pos: int = 0) -> tuple:
+    kind = data[pos:pos + 1]
+    if kind == b'i':
+        end = data.index(b'e', pos)
+        return int(data[pos + 1:end]), end + 1
+    if kind == b'l' or kind == b'd':
+        items = []
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            if pos >= len(data):
+                raise ValueError('Truncated bencoded data')
+            value, pos = bdecode(data, pos)
+            items.append(value)
+        if kind == b'l':
+            return items, pos + 1
+        return dict(zip(items[0::2], items[1::2])), pos + 1
+    colon = data.index(b':', pos)
+    end = colon + 1 + int(data[pos:colon])
+    if end > len(data):
+        raise ValueError('Truncated bencoded data')
+    return data[colon + 1:end], end
+
+# Returns: (magnet link with the trackers of the torrent, torrent name)
+def read_torrent(path: str) -> tuple:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:1] != b'd':
+        raise ValueError('Not a torrent file')
+    meta = {}
+    info_span = None
+    pos = 1
+    while data[pos:pos + 1] != b'e':
+        key, pos = bdecode(data, pos)
+        start = pos
+        meta[key], pos = bdecode(data, pos)
+        if key == b'info':
+            info_span = (start, pos) # Info hash is over the info dictionary exactly as encoded
+    if info_span is None:
+        raise ValueError('No info in torrent file')
+    name = meta[b'info'].get(b'name', b'').decode('utf-8', 'replace')
+    trackers = [meta[b'announce']] if b'announce' in meta else []
+    for tier in meta.get(b'announce-list', []):
+        trackers += [t for t in tier if t not in trackers]
+    url = f'magnet:?xt=urn:btih:{hashlib.sha1(data[info_span[0]:info_span[1]]).hexdigest()}&dn={urllib.parse.quote(name)}'
+    for tracker in trackers:
+        url += '&tr=' + urllib.parse.quote(tracker.decode('utf-8', 'replace'), safe='')
+    return url, name
+
+# Returns: download URLs in a text file, also Windows ".url" shortcuts ("URL=...")
+def read_links(path: str) -> list:
+    urls = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('URL='):
+                line = line[4:]
+            match = INTAKE_URL_PATTERN.search(line)
+            if match and match.group(0) not in urls:
+                urls.append(match.group(0))
+    return urls
+
+# Returns: name for a new task folder based on [name], not taken yet
+def get_free_task_name(name: str) -> str:
+    for char in ':/\\|*?"<>':
+        name = name.replace(char, '_')
+    name = name.strip(' .') or 'task'
+    new_name = name
+    number = 1
+    while os.path.exists(os.path.join(WORKSPACE, new_name)):
+        new_name = f'{name}_{number}'
+        number += 1
+    return new_name
+
+# Creates a task for an intake item. [content]: finished download to move into the task, or '' to download [url].
+# The task is leased while being set up, so workers do not start it half made.
+def create_intake_task(name: str, url: str, category: str, content: str = '') -> Task:
+    while True:
+        name = get_free_task_name(name)
+        try:
+            os.mkdir(os.path.join(WORKSPACE, name))
+            break
+        except FileExistsError:
+            continue # Taken meanwhile by another gecchi
+    task = Task()
+    lease = TaskLease(os.path.join(WORKSPACE, name), get_worker_id(), 'intake')
+    lease.create()
+    try:
+        task.initialize_new(WORKSPACE, name, url, category)
+        if content != '':
+            shutil.move(content, os.path.join(task.content_folder, os.path.basename(content)))
+            task.set_status(STATUS_DOWNLOADED, get_folder_size(task.content_folder))
+    finally:
+        lease.release()
+    print(f'Created task [{name}] ({task.status}, category {category}).')
+    return task
+
+# Returns: tasks created for the dropped item at [path]
+def intake_item(path: str, category: str, intake_folder: str) -> list:
+    name = os.path.basename(path)
+    stem, ext = split_ext(name)
+    ext = ext.lower()
+    if os.path.isdir(path) or (ext != '.torrent' and (ext not in INTAKE_LINK_SUFFIXES or os.path.getsize(path) > INTAKE_LINK_MAX_SIZE)):
+        print(f'Intake: finished download [{name}].')
+        return [create_intake_task(name if os.path.isdir(path) else stem, f'local:{name}', category, path)]
+
+    urls = []
+    try:
+        if ext == '.torrent':
+            url, torrent_name = read_torrent(path)
+            urls = [(torrent_name or stem, url)]
+        else:
+            links = read_links(path)
+            for i in range(len(links)):
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(links[i]).query) if links[i].startswith('magnet:') else {}
+                task_name = query['dn'][0] if 'dn' in query else (stem if len(links) == 1 else f'{stem}_{i + 1}')
+                urls.append((task_name, links[i]))
+    except (OSError, ValueError, IndexError, KeyError, AttributeError) as e:
+        print(f'Intake: failed reading [{name}]: {e}')
+    if len(urls) == 0:
+        print(f'Intake: no download link in [{name}].')
+
+    tasks = []
+    for task_name, url in urls:
+        record = check_history(url)
+        if record is not None:
+            print(f'Intake: [{url}] was already added as task [{record["task"]}] ({record["status"]}), not adding again.')
+            continue
+        tasks.append(create_intake_task(task_name, url, category))
+    move_files([path], os.path.join(intake_folder, INTAKE_DONE_FOLDER if len(tasks) > 0 else INTAKE_REJECTED_FOLDER))
+    return tasks
+
+# Returns: something that changes while an item is being written
+def get_item_signature(path: str) -> tuple:
+    try:
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            return st.st_size, st.st_mtime_ns
+        count = 0
+        latest = os.stat(path).st_mtime_ns
+        for dir_path, dir_names, file_names in os.walk(path):
+            for name in dir_names + file_names:
+                st = os.stat(os.path.join(dir_path, name), follow_symlinks=False)
+                count += st.st_size + 1
+                latest = max(latest, st.st_mtime_ns)
+        return count, latest
+    except OSError:
+        return None # Changing right now
+
+def is_partial_item(name: str) -> bool:
+    return name.startswith('.') or any(name.lower().endswith(suffix) for suffix in INTAKE_PARTIAL_SUFFIXES)
+
+# Runs tasks handed over by intake one after another, each under a lease so workers leave them alone
+def run_intake_tasks(tasks: queue.Queue):
+    worker = get_worker_id()
+    while True:
+        if tasks.empty():
+            refresh_library_index() # Idle, and the index is only used from this thread
+        task = tasks.get()
+        lease = TaskLease(task.folder, worker, WORKER_STAGES.get(task.status, 'intake'))
+        if not lease.try_acquire():
+            continue # Taken by a worker
+        task.lease = lease
+        try:
+            print('==============================================')
+            print(f'Running task [{task.name}]...')
+            if task.run():
+                print(f'Task [{task.name}] done ({task.get_status_text()}).')
+            else:
+                print(f'Task [{task.name}] failed at status [{task.status}].')
+        finally:
+            task.release_lease()
+
+# Watches the drop folder and creates a task for each item dropped there: a ".torrent" file, a text file
+# of download links (one task per link), or anything else as a finished download. New tasks are run
+# right away unless [run_tasks] is off, then they are left to workers.
+def run_intake(run_tasks: bool):
+    set_unattended('intake')
+    intake_folder = INTAKE_FOLDER or os.path.join(WORKSPACE, INTAKE_DEFAULT_FOLDER)
+    if INTAKE_CATEGORY not in ['', *CATEGORIES]:
+        print(f'Unknown GECCHI_INTAKE_CATEGORY [{INTAKE_CATEGORY}], categories are: {", ".join(CATEGORIES)}')
+        return
+    folders = {intake_folder: INTAKE_CATEGORY} # Folder -> category of items dropped there
+    for category in CATEGORIES:
+        folders[os.path.join(intake_folder, category)] = category
+    for folder in list(folders) + [os.path.join(intake_folder, INTAKE_DONE_FOLDER), os.path.join(intake_folder, INTAKE_REJECTED_FOLDER)]:
+        os.makedirs(folder, exist_ok=True)
+
+    watcher = FolderWatcher(INTAKE_POLL_INTERVAL)
+    for folder in folders:
+        if not watcher.add(folder):
+            print(f'Failed watching folder [{folder}].')
+            return
+    print(f'Watching [{intake_folder}]{" (polling)" if watcher.is_polling() else ""}.')
+    if INTAKE_CATEGORY == '':
+        print('Items dropped at the top need GECCHI_INTAKE_CATEGORY, drop them into a category folder.')
+
+    tasks = queue.Queue()
+    if run_tasks:
+        threading.Thread(target=run_intake_tasks, args=(tasks,), daemon=True).start()
+    finished = set() # Items known to be complete
+    unsettled = {} # Item -> (signature, time first seen with it)
+    ignored = {} # Item -> signature, not taken as it is
+    events = []
+    try:
+        while True:
+            finished.update(os.path.join(folder, name) for folder, name, done in events if done)
+            now = time.monotonic()
+            present = set()
+            for folder, category in folders.items():
+                for name in os.listdir(folder):
+                    path = os.path.join(folder, name)
+                    present.add(path)
+                    if is_partial_item(name) or path in folders:
+                        continue
+                    if path not in finished:
+                        signature = get_item_signature(path)
+                        if signature is None or ignored.get(path) == signature:
+                            continue
+                        if path not in unsettled or unsettled[path][0] != signature:
+                            unsettled[path] = (signature, now)
+                            continue
+                        if now - unsettled[path][1] < INTAKE_SETTLE:
+                            continue
+                    finished.discard(path)
+                    unsettled.pop(path, None)
+                    if category == '':
+                        print(f'Intake: no category for [{name}], set GECCHI_INTAKE_CATEGORY or move it into a category folder.')
+                        ignored[path] = get_item_signature(path)
+                        continue
+                    ignored.pop(path, None)
+                    for task in intake_item(path, category, intake_folder):
+                        if run_tasks:
+                            tasks.put(task)
+            finished &= present
+            for path in [p for p in unsettled if p not in present]:
+                del unsettled[path]
+            # Sleeps until something is dropped, or until unsettled items are due for another look
+            events = watcher.wait(INTAKE_SETTLE / 2 if len(unsettled) > 0 else None)
+    finally:
+        watcher.close()
+
+def resume_pending_tasks():
+    resumed = False
+    for task in get_current_tasks():
+        if not task.can_resume_pending():
+            continue
+        resumed = True
+        lease = lease_task(task)
+        if lease is None:
+            continue
+        try:
+            print('==============================================')
+            success = task.run()
+        finally:
+            task.release_lease()
+        if success:
+            print(f'Task [{task.name}] done ({task.get_status_text()}).')
+        else:
+            print(f'Task [{task.name}] failed at status [{task.status}].')
+    if not resumed:
+        print('No archive waiting for a password.')
+
 def get_current_tasks() -> list:
     tasks = []
     for file in os.listdir(WORKSPACE):
+        if file.startswith('.'):
+            continue # Gecchi internal folder, like resource locks
         if os.path.isdir(os.path.join(WORKSPACE, file)):
             task = Task()
             if task.initialize_load(WORKSPACE, file):
@@ -743,6 +2963,14 @@ def get_current_tasks() -> list:
                 #shutil.rmtree(os.path.join(WORKSPACE, file))
     return tasks
 
+# Prints tasks without reading categories or starting any external tool
+def print_status():
+    tasks = get_current_tasks()
+    if len(tasks) == 0:
+        print('No existing task found.')
+    for task in tasks:
+        print(f'[{task.get_status_text()}] {task.name} ({task.category})')
+
 def new_task() -> Task:
     task = Task()
     while True:
@@ -768,70 +2996,153 @@ def new_task() -> Task:
 
         break
 
-    task.initialize_new(WORKSPACE, name, input('Enter download URL: '), prompt_for_category()) # Assuming not failing
+    while True:
+        url = input('Enter download URL: ')
+        record = check_history(url)
+        if record is not None:
+            when = datetime.datetime.fromtimestamp(record['updated']).strftime('%Y-%m-%d')
+            size = f', {format_bytes(record["size"])}' if record['size'] is not None else ''
+            print(f'This source was already added as task [{record["task"]}] ({record["status"]}{size}, {when}, category {record["category"]}).')
+            existing = Task()
+            if os.path.isdir(os.path.join(WORKSPACE, record['task'])) and existing.initialize_load(WORKSPACE, record['task']):
+                text = input('Enter "y" to download it again, "o" to open the existing task, or nothing to enter another URL: ')
+                if text == 'o':
+                    os.rmdir(os.path.join(WORKSPACE, name))
+                    return existing
+            else:
+                text = input('Enter "y" to download it again, or nothing to enter another URL: ')
+            if text != 'y':
+                continue
+        if not url.startswith('https://pan.baidu.com/s/') or BDUSS == '' or STOKEN == '':
+            break
+        if len(check_baidu_links([url])) > 0 or input('Use this URL anyway? Enter "y" to use (default entering another): ') == 'y':
+            break
+    task.initialize_new(WORKSPACE, name, url, prompt_for_category()) # Assuming not failing
     return task
 
-# Check args
-if len(sys.argv) < 2:
-    print('Usage: gecchi.py [workspace]')
-    exit(-1)
+def main():
+    global WORKSPACE
+
+    # Check args
+    if len(sys.argv) < 2:
+        print('Usage: gecchi.py [workspace] [command]')
+        print('Commands: status (print tasks and exit), password PASSWORD... (add passwords and resume deferred archives),')
+        print('          check [URL...] (check Baidu share links, read from stdin if none given),')
+        print('          worker [STAGES] [--exit-when-done] (run stages of tasks along with other workers, STAGES e.g. "extract,copy")')
+        print('          intake [--no-run] (create tasks from items dropped into the intake folder and run them)')
+        print('          bt-hook install [--force] (make qBittorrent notify gecchi when a torrent finishes), bt-hook HASH (run by qBittorrent)')
+        exit(-1)
 
-WORKSPACE = sys.argv[1]
-if not os.path.isdir(WORKSPACE):
-    print(f'Provided workspace does not exist: {WORKSPACE}')
-    exit(-1)
-if not read_categories():
-    exit(-1)
+    WORKSPACE = sys.argv[1]
+    if not os.path.isdir(WORKSPACE):
+        print(f'Provided workspace does not exist: {WORKSPACE}')
+        exit(-1)
+    command = sys.argv[2] if len(sys.argv) > 2 else ''
+    if command == 'status':
+        print_status()
+        exit(0)
+    elif command == 'check':
+        urls = sys.argv[3:] if len(sys.argv) > 3 else [line.strip() for line in sys.stdin if line.strip() != '']
+        alive = check_baidu_links(urls)
+        if len(alive) > 0 and len(alive) < len(urls):
+            print('Alive links:')
+            for url in alive:
+                print(url)
+        exit(0)
+    elif command == 'bt-hook':
+        if len(sys.argv) < 4:
+            print('Usage: gecchi.py [workspace] bt-hook (HASH | install)')
+            exit(-1)
+        if sys.argv[3] == 'install':
+            exit(0 if install_bt_hook('--force' in sys.argv[4:]) else -1)
+        notify_bt_completed(sys.argv[3])
+        exit(0)
+    elif command not in ['', 'password', 'worker', 'intake']:
+        print(f'Unknown command: {command}')
+        exit(-1)
 
-# Check environment
-if os.name == 'nt':
-    SEVENZIP_PATH = os.environ.get('SEVENZIP_PATH', '7z.exe')
-else:
-    SEVENZIP_PATH = os.environ.get('SEVENZIP_PATH', '7zz')
+    if not read_categories():
+        exit(-1)
+    load_passwords()
+
+    if PROFILE:
+        atexit.register(print_profile_summary)
+
+    if command == 'password':
+        if len(sys.argv) < 4:
+            print('Usage: gecchi.py [workspace] password PASSWORD...')
+            exit(-1)
+        add_passwords(sys.argv[3:])
+        resume_pending_tasks()
+        exit(0)
+
+    if command == 'worker':
+        args = [arg for arg in sys.argv[3:] if not arg.startswith('--')]
+        stages = args[0].split(',') if len(args) > 0 else list(WORKER_STAGES.values())
+        if any(stage not in WORKER_STAGES.values() for stage in stages):
+            print(f'Unknown stage in [{",".join(stages)}], stages are: {", ".join(WORKER_STAGES.values())}')
+            exit(-1)
+        try:
+            run_worker(stages, '--exit-when-done' in sys.argv[3:])
+        except KeyboardInterrupt:
+            print('\nWorker stopped.')
+        exit(0)
 
-MEGACMD_FOLDER = os.environ.get('MEGACMD_FOLDER', '')
+    if command == 'intake':
+        try:
+            run_intake('--no-run' not in sys.argv[3:])
+        except KeyboardInterrupt:
+            print('\nIntake stopped.')
+        exit(0)
 
-if not ensure_executables():
-    exit(-1)
+    try:
+        import readline # Line editing for input(), only useful when interactive
+    except ImportError:
+        pass
 
-BDUSS = os.environ.get('BDUSS', '')
-STOKEN = os.environ.get('STOKEN', '')
-if BDUSS == '' or STOKEN == '':
-    print('Warning: "BDUSS" or "STOKEN" environment variable not set. Baidu download will be unavailable.')
+    if BDUSS == '' or STOKEN == '':
+        print('Warning: "BDUSS" or "STOKEN" environment variable not set. Baidu download will be unavailable.')
 
-# Print tasks first
-tasks = get_current_tasks()
+    # Print tasks first
+    tasks = get_current_tasks()
 
-if len(tasks) == 0:
-    print('No existing task found.')
-else:
-    print('Current gecchi tasks:')
-    for i in range(len(tasks)):
-        print(f'{i + 1}: [{tasks[i].status}] {tasks[i].name}')
-        
-while True:
     if len(tasks) == 0:
-        text = ''
+        print('No existing task found.')
     else:
-        text = input(f'Select a task to check (1 ~ {len(tasks)}) or enter nothing for a new task: ')
-    if text == '':
-        task = new_task()
-        break
-    else:
-        try:
-            val = int(text)
-        except:
-            print('Invalid choice.')
-            continue
+        print('Current gecchi tasks:')
+        for i in range(len(tasks)):
+            print(f'{i + 1}: [{tasks[i].get_status_text()}] {tasks[i].name}')
+        
+    while True:
+        if len(tasks) == 0:
+            text = ''
         else:
-            if val >= 1 and val <= len(tasks):
-                task = tasks[val - 1]
-            else:
-                print('Index out of range.')
+            text = input(f'Select a task to check (1 ~ {len(tasks)}), "a" to run all tasks, or enter nothing for a new task: ')
+        if text == '':
+            task = new_task()
+            break
+        elif text == 'a':
+            delete_done = input('Delete tasks after success? Enter "y" to delete (default retaining): ') == 'y'
+            run_all_tasks(tasks, delete_done)
+            exit(0)
+        else:
+            try:
+                val = int(text)
+            except:
+                print('Invalid choice.')
                 continue
-        break
+            else:
+                if val >= 1 and val <= len(tasks):
+                    task = tasks[val - 1]
+                else:
+                    print('Index out of range.')
+                    continue
+            break
         
-while (task_operations(task)):
-    pass
+    while (task_operations(task)):
+        pass
+
+    exit(0)
 
-exit(0)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import os
+import time
+import sqlite3
+import hashlib
+import subprocess
+
+HASH_CHUNK_SIZE = 2**20
+DEDUP_MIN_SIZE = 2**16 # Smaller files are not worth a link
+RESCAN_INTERVAL = 6 * 3600 # Seconds before a library root is walked again
+
+# Index of files in the category folders, kept in a SQLite database.
+# Files are hashed lazily: only when another file of the same size shows up.
+class LibraryIndex:
+    def __init__(self, db_path: str):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, scanned REAL, mtime INTEGER)')
+        if 'mtime' not in [row[1] for row in self.db.execute('PRAGMA table_info(roots)')]:
+            self.db.execute('ALTER TABLE roots ADD COLUMN mtime INTEGER') # Index made by an older version
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def is_scanned(self, root: str) -> bool:
+        return self.get_scanned(root) is not None
+
+    # Returns: time [root] was last scanned, None if never
+    def get_scanned(self, root: str) -> float:
+        row = self.db.execute('SELECT scanned FROM roots WHERE path = ?', (os.path.abspath(root),)).fetchone()
+        return row[0] if row is not None else None
+
+    # Files may be added to or removed from the library outside gecchi. Returns: whether entries of [root]
+    # itself changed (its mtime) since it was scanned, other than by gecchi (see update_root).
+    def needs_scan(self, root: str) -> bool:
+        row = self.db.execute('SELECT scanned, mtime FROM roots WHERE path = ?', (os.path.abspath(root),)).fetchone()
+        if row is None:
+            return True
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            return False
+        if row[1] is None:
+            return mtime > row[0] * 1e9
+        return mtime != row[1]
+
+    # Deeper changes do not show in the mtime of [root]. Returns: whether RESCAN_INTERVAL passed since the last scan.
+    def is_stale(self, root: str) -> bool:
+        scanned = self.get_scanned(root)
+        return scanned is None or time.time() - scanned > RESCAN_INTERVAL
+
+    # Records that gecchi itself changed the entries of [root], e.g. created a folder there, so it is not
+    # taken for an outside change. [mtime_before]: st_mtime_ns of [root] before the change.
+    def update_root(self, root: str, mtime_before: int):
+        root = os.path.abspath(root)
+        self.db.execute('UPDATE roots SET mtime = ? WHERE path = ? AND mtime = ?', (os.stat(root).st_mtime_ns, root, mtime_before))
+        self.db.commit()
+
+    # Brings the index of [folder] up to date. Unchanged files keep their hash, so a rescan only costs a walk.
+    # Returns: number of new or changed files
+    def scan(self, folder: str) -> int:
+        folder = os.path.abspath(folder)
+        root_mtime = os.stat(folder).st_mtime_ns # Before walking, so changes made meanwhile are picked up next time
+        known = {}
+        prefix = os.path.join(folder, '')
+        for path, size, mtime in self.db.execute('SELECT path, size, mtime FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)):
+            known[path] = (size, mtime)
+
+        changed = 0
+        for dir_path, dir_names, file_names in os.walk(folder):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    continue
+                if known.pop(path, None) == (st.st_size, st.st_mtime_ns):
+                    continue
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL)', (path, st.st_size, st.st_mtime_ns))
+                changed += 1
+
+        self.db.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in known))
+        self.db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?, ?)', (folder, time.time(), root_mtime))
+        self.db.commit()
+        return changed
+
+    def add(self, path: str, file_hash: str = None):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, file_hash))
+
+    def commit(self):
+        self.db.commit()
+
+    # Returns: hash of an indexed file, computed and stored if missing. None if the file changed or vanished.
+    def get_hash(self, path: str, size: int, mtime: int, file_hash: str) -> str:
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            return None
+        if st.st_size != size or st.st_mtime_ns != mtime:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL)', (path, st.st_size, st.st_mtime_ns))
+            return None
+        if file_hash is None:
+            file_hash = hash_file(path)
+            self.db.execute('UPDATE files SET hash = ? WHERE path = ?', (file_hash, path))
+        return file_hash
+
+    # Returns: (path of an indexed file with same content or '', hash of [file] or None if not computed)
+    # Indexed files under [exclude] folder are not considered.
+    def find_duplicate(self, file: str, exclude: str = '') -> tuple:
+        size = os.path.getsize(file)
+        if size < DEDUP_MIN_SIZE:
+            return '', None
+        candidates = self.db.execute('SELECT path, size, mtime, hash FROM files WHERE size = ?', (size,)).fetchall()
+        if exclude != '':
+            prefix = os.path.join(os.path.abspath(exclude), '')
+            candidates = [c for c in candidates if not c[0].startswith(prefix)]
+        if len(candidates) == 0:
+            return '', None # Size prefilter, nothing to hash
+
+        file_hash = hash_file(file)
+        for path, size, mtime, candidate_hash in candidates:
+            if self.get_hash(path, size, mtime, candidate_hash) == file_hash:
+                return path, file_hash
+        return '', file_hash
+
+    # Cheap match for files not downloaded yet, by file name and size.
+    # Returns: path of an indexed file with same name and size, or ''
+    def find_by_name_size(self, name: str, size: int) -> str:
+        name = os.path.normcase(os.path.basename(name))
+        for (path,) in self.db.execute('SELECT path FROM files WHERE size = ?', (size,)):
+            if os.path.normcase(os.path.basename(path)) == name:
+                return path
+        return ''
+
+def hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# Makes [dest] share the data of [src]. mode: 'hardlink' or 'reflink'
+def link_file(src: str, dest: str, mode: str) -> bool:
+    try:
+        if mode == 'hardlink':
+            os.link(src, dest)
+            return True
+        if mode == 'reflink':
+            return subprocess.run(['cp', '--reflink=always', src, dest], capture_output=True).returncode == 0
+    except OSError:
+        pass
+    return False
@@ -0,0 +1,349 @@
+# Benchmark for the network clients (Baidu share API and qBittorrent through qbt),
+# against local stand-in servers. Runs offline. Usage: python netbench.py --help
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import gecchi
+from baidu_share import BaiDuPan
+
+SHARE_PASSWORD = 'abcd'
+
+# Shares served by the Baidu stand-in: every 3rd one has a password, every 5th one is gone
+class ShareStore:
+    def __init__(self, count: int, files_per_folder: int, seed: int):
+        rng = random.Random(seed)
+        self.shares = {}
+        for i in range(count):
+            surl = f'bench{i}'
+            files = [{'fs_id': i * 1000 + j, 'isdir': 0, 'path': f'/share{i}/folder/{j:04d}.jpg', 'size': rng.randint(2**20, 8 * 2**20)}
+                     for j in range(files_per_folder)]
+            self.shares[surl] = {
+                'dead': i % 5 == 4,
+                'password': SHARE_PASSWORD if i % 3 == 2 else None,
+                'shareid': 10000 + i,
+                'uk': 20000 + i,
+                'top': [{'fs_id': i * 1000 + 999, 'isdir': 1, 'path': f'/share{i}/folder', 'size': 0},
+                        {'fs_id': i * 1000 + 998, 'isdir': 0, 'path': f'/share{i}/readme.txt', 'size': 1024}],
+                'files': files,
+            }
+
+    def urls(self) -> list:
+        ret = []
+        for surl, share in self.shares.items():
+            url = f'https://pan.baidu.com/s/1{surl}'
+            ret.append(url + f'?pwd={share["password"]}' if share['password'] else url)
+        return ret
+
+# Counts requests by path, for the operation being measured
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, path: str):
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def take(self) -> dict:
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+def make_handler(server_name: str, latency: float, counter: Counter, route):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, like the real services
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle_request(self, method: str):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query.replace('\t', '').replace(' ', '')))
+            length = int(self.headers.get('Content-Length', 0))
+            form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode())) if length > 0 else {}
+            counter.add(f'{server_name} {method} {url.path}')
+            time.sleep(latency)
+            status, headers, body = route(method, url.path, query, form, self.headers.get('Cookie', ''))
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body)
+            data = body.encode('utf-8')
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.handle_request('GET')
+
+        def do_POST(self):
+            self.handle_request('POST')
+    return Handler
+
+def start_server(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Stand-in for the pan.baidu.com endpoints used by BaiDuPan
+def baidu_route(store: ShareStore):
+    def route(method, path, query, form, cookie):
+        if path == '/':
+            return 200, {}, '<title>百度网盘</title> "bdstoken":"benchtoken" "username":"bench"'
+        if path == '/api/list':
+            return 200, {}, {'errno': 0, 'list': [{'fs_id': 1, 'isdir': 1, 'path': '/apps', 'size': 0}]}
+        if path == '/error/404.html':
+            return 200, {}, '404'
+        if path.startswith('/s/1'):
+            share = store.shares.get(path[4:])
+            if share is None:
+                return 302, {'Location': '/error/404.html'}, ''
+            if share['dead']:
+                return 200, {}, '啊哦，你来晚了，分享的文件已经被删除了，下次要早点哟'
+            if share['password'] and f'BDCLND={path[4:]}' not in cookie:
+                return 302, {'Location': f'/share/init?surl={path[4:]}'}, ''
+            data = {'bdstoken': 'benchtoken', 'shareid': share['shareid'], 'share_uk': share['uk'], 'file_list': share['top']}
+            return 200, {}, f'<script>locals.mset({json.dumps(data)});</script>'
+        if path == '/share/init':
+            return 200, {}, '"bdstoken":"benchtoken"'
+        if path == '/share/verify':
+            share = store.shares.get(query.get('surl', ''))
+            if share is None or form.get('pwd') != share['password']:
+                return 200, {}, {'errno': -9}
+            return 200, {'Set-Cookie': f'BDCLND={query["surl"]}; Path=/'}, {'errno': 0}
+        if path == '/share/list':
+            share = next((s for s in store.shares.values() if str(s['shareid']) == query.get('shareid')), None)
+            if share is None:
+                return 200, {}, {'errno': 2}
+            page = int(query.get('page', 1))
+            num = int(query.get('num', 100))
+            return 200, {}, {'errno': 0, 'list': share['files'][(page - 1) * num:page * num]}
+        if path == '/share/transfer':
+            return 200, {}, {'errno': 0, 'show_msg': 'ok', 'extra': {}, 'info': []}
+        return 404, {}, 'not found'
+    return route
+
+# Sends requests for https://pan.baidu.com to the stand-in server. Cookies and redirects
+# keep seeing the original URL, so the client behaves as it would against the real host.
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, base: str, **kwargs):
+        self.base = base
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        original = request
+        request = request.copy()
+        url = urllib.parse.urlsplit(request.url)
+        request.url = self.base + url.path + ('?' + url.query if url.query else '')
+        response = super().send(request, **kwargs)
+        response.url = original.url
+        response.request = original
+        return response
+
+# Stand-in for the qBittorrent WebUI API, torrents finish after [seconds]
+# on_completed: optional, called with the hash when a torrent finishes, like the program qBittorrent runs
+def qbittorrent_route(seconds: float, size: int, on_completed=None):
+    torrents = {}
+    lock = threading.Lock()
+
+    def info(torrent: dict) -> dict:
+        elapsed = time.time() - torrent['added']
+        has_metadata = elapsed > 0.2
+        progress = min(1.0, elapsed / seconds) if not torrent['paused'] else torrent['progress']
+        torrent['progress'] = progress
+        return {
+            'hash': torrent['hash'],
+            'state': 'pausedDL' if torrent['paused'] else ('uploading' if progress >= 1.0 else 'downloading'),
+            'completion_on': int(time.time()) if progress >= 1.0 else None,
+            'size': size if has_metadata else 0,
+            'completed': int(size * progress),
+            'progress': progress,
+            'dlspeed': int(size / seconds),
+            'eta': int(max(0.0, seconds - elapsed)),
+            'time_active': int(elapsed),
+        }
+
+    def route(method, path, query, form, cookie):
+        with lock:
+            if path == '/api/v2/torrents/info':
+                return 200, {}, [info(t) for t in torrents.values()]
+            if path == '/api/v2/torrents/files':
+                torrent = torrents.get(query.get('hash', ''))
+                if torrent is None:
+                    return 404, {}, 'not found'
+                return 200, {}, [{'index': i, 'name': f'bench/{i:03d}.mkv', 'size': size // 4, 'priority': 1} for i in range(4)]
+            if path == '/api/v2/torrents/add':
+                bt_hash = gecchi.get_bt_hash(form.get('urls', '')).lower()
+                torrents[bt_hash] = {'hash': bt_hash, 'added': time.time(), 'paused': False, 'progress': 0.0}
+                if on_completed is not None:
+                    threading.Timer(seconds, on_completed, [bt_hash]).start()
+                return 200, {}, 'Ok.'
+            hashes = form.get('hashes', '')
+            if path == '/api/v2/torrents/delete':
+                torrents.pop(hashes, None)
+            elif path in ['/api/v2/torrents/pause', '/api/v2/torrents/resume'] and hashes in torrents:
+                torrents[hashes]['paused'] = path.endswith('pause')
+            return 200, {}, 'Ok.'
+    return route
+
+# qbt command line client stand-in, talks to the qBittorrent stand-in like qbt talks to the WebUI
+QBT_SHIM = '''import sys, json, urllib.request, urllib.parse
+base = {base!r}
+def call(path, form=None, query=None):
+    url = base + path + ('?' + urllib.parse.urlencode(query) if query else '')
+    data = urllib.parse.urlencode(form).encode() if form is not None else None
+    return urllib.request.urlopen(url, data).read().decode()
+args = sys.argv[1:]
+if len(args) < 2 or args[0] != 'torrent':
+    print('qbt shim'); sys.exit(0)
+op = args[1]
+if op == 'list':
+    print(call('/api/v2/torrents/info'))
+elif op == 'content':
+    print(call('/api/v2/torrents/files', query={{'hash': args[2]}}))
+elif op == 'add':
+    call('/api/v2/torrents/add', {{'urls': args[3], 'savepath': args[args.index('--folder') + 1] if '--folder' in args else ''}})
+elif op in ['delete', 'pause', 'resume']:
+    call('/api/v2/torrents/' + op, {{'hashes': args[2]}})
+elif op == 'file':
+    call('/api/v2/torrents/filePrio', {{'hash': args[3], 'id': args[4], 'priority': 0 if args[5] == 'skip' else 1}})
+elif op == 'limit':
+    call('/api/v2/torrents/setDownloadLimit', {{'hashes': args[3], 'limit': args[-1]}})
+'''
+
+def write_qbt_shim(folder: str, base: str) -> str:
+    path = os.path.join(folder, 'qbt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'#!{sys.executable}\n' + QBT_SHIM.format(base=base))
+    os.chmod(path, 0o755)
+    return path
+
+def measure(name: str, counter: Counter, func, operations: int = 1) -> dict:
+    counter.take()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    counts = counter.take()
+    requests_count = sum(counts.values())
+    return {
+        'operation': name,
+        'count': operations,
+        'seconds': seconds,
+        'requests': requests_count,
+        'requests_per_op': requests_count / operations,
+        'ms_per_op': seconds / operations * 1000,
+        'ops_per_second': operations / seconds if seconds > 0 else 0,
+        'paths': counts,
+    }
+
+def baidu_pan(adapter: requests.adapters.HTTPAdapter) -> BaiDuPan:
+    pan = BaiDuPan('bench-bduss', 'bench-stoken')
+    pan.session.mount('https://pan.baidu.com', adapter)
+    return pan
+
+def run_baidu(args, counter: Counter) -> list:
+    store = ShareStore(args.shares, args.files, args.seed)
+    server = start_server(make_handler('baidu', args.latency / 1000, counter, baidu_route(store)))
+    adapter = RedirectAdapter(f'http://127.0.0.1:{server.server_port}', pool_connections=1, pool_maxsize=args.concurrency)
+    results = []
+    try:
+        public = 'https://pan.baidu.com/s/1bench0'
+        protected = 'https://pan.baidu.com/s/1bench2'
+        results.append(measure('baidu getFileList', counter, lambda: baidu_pan(adapter).getFileList()))
+        results.append(measure('baidu saveShare public', counter, lambda: baidu_pan(adapter).saveShare(public, None, '/apps/bypy/bench/')))
+        results.append(measure('baidu saveShare password', counter, lambda: baidu_pan(adapter).saveShare(protected, SHARE_PASSWORD, '/apps/bypy/bench/')))
+        pan = baidu_pan(adapter)
+        pan.saveShare(protected, SHARE_PASSWORD, '/apps/bypy/bench/')
+        results.append(measure('baidu saveShare retry', counter, lambda: pan.saveShare(protected, SHARE_PASSWORD, '/apps/bypy/bench/')))
+        results.append(measure('baidu checkShare', counter, lambda: baidu_pan(adapter).checkShare(protected, SHARE_PASSWORD)))
+        urls = store.urls()
+        checked = []
+        results.append(measure(f'baidu checkShares x{args.concurrency}', counter,
+                               lambda: checked.extend(baidu_pan(adapter).checkShares(urls, args.concurrency, adapter)), len(urls)))
+        alive = len([r for r in checked if r['errno'] == 0])
+        expected = len([s for s in store.shares.values() if not s['dead']])
+        if alive != expected:
+            raise RuntimeError(f'checkShares found {alive} alive shares, expected {expected}: {checked}')
+    finally:
+        server.shutdown()
+    return results
+
+def run_qbittorrent(args, counter: Counter, folder: str) -> list:
+    on_completed = None
+    if args.bt_hook:
+        gecchi.WORKSPACE = folder
+        gecchi.BT_HOOK = True
+        on_completed = gecchi.notify_bt_completed
+    server = start_server(make_handler('qbt', args.latency / 1000, counter, qbittorrent_route(args.torrent_seconds, 2**30, on_completed)))
+    gecchi.QBT_PATH = write_qbt_shim(folder, f'http://127.0.0.1:{server.server_port}')
+    gecchi.BT_POLL_INTERVAL = args.poll_interval
+    gecchi.DISK_SPACE_RESERVE = -2**40 # The torrent is not written, skip the space check
+    bt_hash = '0123456789abcdef0123456789abcdef01234567'
+    if args.bt_hook:
+        os.mkdir(os.path.join(folder, 'bench'))
+        gecchi.write_file(os.path.join(folder, 'bench'), gecchi.URL, bt_hash) # The hook only marks torrents of tasks
+    results = []
+    try:
+        results.append(measure(f'qbt check_bt x{args.polls}', counter, lambda: [gecchi.check_bt(bt_hash) for i in range(args.polls)], args.polls))
+        results.append(measure('qbt download_bt' + (' hook' if args.bt_hook else ''), counter,
+                               lambda: gecchi.download_bt('magnet:?xt=urn:btih:' + bt_hash, bt_hash, folder, lambda files: True)))
+        results[-1]['overshoot'] = results[-1]['seconds'] - args.torrent_seconds # Completion noticed late by polling
+        print('')
+    finally:
+        server.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gecchi network clients against local stand-in servers.')
+    parser.add_argument('--latency', type=float, default=20.0, help='Server latency per request in ms')
+    parser.add_argument('--shares', type=int, default=30, help='Number of shares for the bulk check')
+    parser.add_argument('--files', type=int, default=250, help='Files per shared folder (share/list pages of 100)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Workers for the bulk check')
+    parser.add_argument('--polls', type=int, default=10, help='check_bt calls to time')
+    parser.add_argument('--poll-interval', type=float, default=gecchi.BT_POLL_INTERVAL, help='BT_POLL_INTERVAL for download_bt')
+    parser.add_argument('--torrent-seconds', type=float, default=3.0, help='Time the stand-in torrent takes to complete')
+    parser.add_argument('--bt-hook', action='store_true', help='Wait for the completion hook in download_bt instead of polling')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for share sizes')
+    parser.add_argument('--skip-bt', action='store_true', help='Only run the Baidu benchmark')
+    parser.add_argument('--json', default=None, help='Also write results to this JSON file')
+    args = parser.parse_args()
+
+    counter = Counter()
+    folder = tempfile.mkdtemp(prefix='gecchi-netbench-')
+    results = []
+    try:
+        print('Running Baidu share benchmark...')
+        results += run_baidu(args, counter)
+        if not args.skip_bt:
+            print('Running qBittorrent benchmark...')
+            results += run_qbittorrent(args, counter, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print(f'Server latency: {args.latency:.0f} ms per request')
+    print(f'{"operation":<28}{"count":>6}{"seconds":>9}{"requests":>10}{"req/op":>8}{"ms/op":>9}{"op/s":>8}')
+    for r in results:
+        print(f'{r["operation"]:<28}{r["count"]:>6}{r["seconds"]:>9.2f}{r["requests"]:>10}{r["requests_per_op"]:>8.1f}'
+              f'{r["ms_per_op"]:>9.1f}{r["ops_per_second"]:>8.1f}')
+    for r in results:
+        if 'overshoot' in r:
+            print(f'{r["operation"]}: completion noticed {r["overshoot"]:.2f}s after the torrent finished')
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'latency_ms': args.latency, 'results': results}, f, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import socket
+import threading
+
+LEASE_FILE = 'LEASE'
+LEASE_TIMEOUT = 120.0 # Seconds without heartbeat before a lease is stale
+LEASE_HEARTBEAT = 30.0
+RECOVER_SUFFIX = '.recover'
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+# Returns: content of the lease in [folder], None if not leased
+def read_lease(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, LEASE_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_stale(path: str) -> bool:
+    try:
+        return time.time() - os.path.getmtime(path) > LEASE_TIMEOUT
+    except OSError:
+        return True # Gone
+
+def is_leased(folder: str) -> bool:
+    path = os.path.join(folder, LEASE_FILE)
+    return os.path.exists(path) and not is_stale(path)
+
+# Raised when a worker finds its lease taken over, so it stops before writing over the new holder's work
+class LeaseLost(Exception):
+    pass
+
+# Exclusive claim of a task folder by one worker, through files only, so it also works for
+# workers on several machines sharing the workspace (O_EXCL creation is atomic on NFSv3+).
+# The holder touches the lease file every LEASE_HEARTBEAT seconds. A lease not touched for
+# LEASE_TIMEOUT is stale, its worker is gone, and another worker may take it over.
+class TaskLease:
+    def __init__(self, folder: str, worker: str, stage: str):
+        self.path = os.path.join(folder, LEASE_FILE)
+        self.worker = worker
+        self.stage = stage
+        self.previous = None # Content of the stale lease taken over
+        self.lost = False # Heartbeat failed, another worker may have taken over
+        self.stop = threading.Event()
+        self.thread = None
+
+    def create(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'worker': self.worker, 'stage': self.stage, 'acquired': time.time()}, f)
+        return True
+
+    # Only one worker recovers a task at a time, so nobody removes a lease another worker just created
+    def recover(self) -> bool:
+        guard = self.path + RECOVER_SUFFIX
+        if os.path.exists(guard) and is_stale(guard):
+            try:
+                os.remove(guard) # Left by a worker that died while recovering
+            except OSError:
+                pass
+        try:
+            os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            return False
+        try:
+            if os.path.exists(self.path):
+                if not is_stale(self.path):
+                    return False
+                self.previous = read_lease(os.path.dirname(self.path)) or {}
+                os.remove(self.path)
+            return self.create()
+        finally:
+            os.remove(guard)
+
+    def try_acquire(self) -> bool:
+        if not self.create() and not self.recover():
+            return False
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def heartbeat(self):
+        while not self.stop.wait(LEASE_HEARTBEAT):
+            lease = read_lease(os.path.dirname(self.path))
+            if lease is None or lease.get('worker') != self.worker:
+                self.lost = True # Taken over, touching it would keep the other worker's lease alive
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost = True
+                return
+
+    # Returns: whether this worker still holds the lease. Reads the lease file, so a takeover shows
+    # before the next heartbeat.
+    def is_held(self) -> bool:
+        if not self.lost:
+            lease = read_lease(os.path.dirname(self.path))
+            self.lost = lease is None or lease.get('worker') != self.worker
+        return not self.lost
+
+    def release(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        lease = read_lease(os.path.dirname(self.path))
+        if lease is not None and lease.get('worker') == self.worker:
+            os.remove(self.path)